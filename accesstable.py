@@ -0,0 +1,103 @@
+## @package accesstable
+# Sendmail style access file compiled into memory.
+#
+# MTAPolicy looks up as many as four keys in the access database for
+# every policy tag, and a message can ask for half a dozen tags for the
+# sender and HELO name.  AccessTable reads the whole database once into
+# dictionaries indexed by the name after the tag, so each getPolicy()
+# is a few dictionary lookups instead of database reads.  The table is
+# reloaded and swapped when the file changes.
+#
+# Author: Stuart D. Gathman <stuart@gathman.org>
+# This code is under the GNU General Public License.  See COPYING for details.
+
+import os
+import time
+import threading
+
+class AccessTable(object):
+  """Policy tags by sender and domain.
+
+  Keys are tag!sender, tag!domain, tag! or tag, as produced by makemap
+  from an access file.  They are looked up in that order, exactly as
+  Milter.policy.MTAPolicy does, so a table gives the same answers as
+  the database it was read from.  With nulls, only keys ending in a
+  null byte match, as with access_file_nulls.
+  >>> t = AccessTable()
+  >>> t.update([('spf-pass!example.com','OK'),('spf-neutral!example.com','REJECT'),
+  ...     ('spf-permerror!foo@bad.example.com','OK'),('spf-permerror!','REJECT'),
+  ...     ('smtp-test!.baz.com','WILDCARD'),('smtp-test','REJECT')])
+  >>> t.getPolicy('spf-pass','good@example.com','example.com')
+  'OK'
+  >>> t.getPolicy('spf-permerror','foo@bad.example.com','bad.example.com')
+  'OK'
+  >>> t.getPolicy('spf-permerror','bar@bad.example.com','bad.example.com')
+  'REJECT'
+  >>> t.getPolicy('smtp-test','foo@bar.baz.com','bar.baz.com')
+  'REJECT'
+  >>> t.getPolicy('spf-fail','foo@baz.com','baz.com')
+  """
+
+  def __init__(self,nulls=False):
+    self.nulls = nulls
+    self.names = {}             # sender, domain or '' -> {tag: value}
+    self.tags = {}              # tag -> value for keys without a name
+
+  ## Add (key,value) pairs from an access database.
+  def update(self,items):
+    for key,val in items:
+      if isinstance(key,bytes): key = key.decode('utf-8','replace')
+      if isinstance(val,bytes): val = val.decode('utf-8','replace')
+      if self.nulls:
+        if not key.endswith('\0'): continue
+        key = key[:-1]
+      val = val.rstrip('\0')
+      tag,sep,name = key.partition('!')
+      if sep:
+        self.names.setdefault(name,{})[tag] = val
+      else:
+        self.tags[tag] = val
+
+  ## Return the value for tag, looking up sender, domain, tag! and tag
+  # in turn, or None.
+  def getPolicy(self,tag,sender,domain):
+    for name in (sender,domain,''):
+      d = self.names.get(name)
+      if d and tag in d: return d[tag]
+    return self.tags.get(tag)
+
+def dbitems(acf):
+  f = getattr(acf,'f',acf)      # unwrap Milter.policy.DB
+  if hasattr(f,'items'):
+    return f.items()
+  return ((k,f[k]) for k in f.keys())
+
+_tables = {}
+_lock = threading.Lock()
+
+## Return the AccessTable for an access database, reloading it if the
+# file has changed.  The file is checked at most once per interval.
+# @param dbmopen function to open the database read only
+# @param nulls True if keys end with a null byte
+def get(fname,dbmopen,nulls=False,interval=1.0):
+  now = time.time()
+  r = _tables.get((fname,nulls))
+  if r:
+    table,sig,checked = r
+    if now < checked + interval:
+      return table
+  st = os.stat(fname)
+  newsig = (st.st_ino,st.st_mtime,st.st_size)
+  with _lock:
+    r = _tables.get((fname,nulls))
+    if r and r[1] == newsig:
+      table = r[0]
+    else:
+      table = AccessTable(nulls)
+      acf = dbmopen(fname,'r')
+      try:
+        table.update(dbitems(acf))
+      finally:
+        acf.close()
+    _tables[fname,nulls] = (table,newsig,now)
+  return table
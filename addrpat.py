@@ -0,0 +1,172 @@
+## @package addrpat
+# Compiled matcher for lists of email address patterns.
+#
+# Checking a sender against a list of patterns with fnmatchcase() costs
+# time in proportion to the length of the list.  AddrPatterns files
+# patterns in a trie of reversed domain labels, and combines the localpart
+# globs for each domain into a single anchored regular expression, so a
+# match costs a few dictionary lookups and at most one regex match per
+# label of the sender's domain.
+#
+# Author: Stuart D. Gathman <stuart@gathman.org>
+# This code is under the GNU General Public License.  See COPYING for details.
+
+import re
+from fnmatch import translate,fnmatchcase
+
+GLOB_CHARS = '*?['
+
+## True if s is a pattern rather than a plain address or domain.
+def is_pattern(s):
+  return s.startswith('!') or any(c in s for c in GLOB_CHARS)
+
+class _Rules(object):
+  "Localpart rules for one domain, by pattern index."
+  def __init__(self):
+    self.users = {}             # user -> index
+    self.any = None             # index of a pattern matching any user
+    self.globs = []             # (index,glob)
+    self.regex = None
+
+  def add(self,i,user):
+    if not user or user == '*':
+      if self.any is None: self.any = i
+    elif any(c in user for c in GLOB_CHARS):
+      self.globs.append((i,user))
+      self.regex = None
+    else:
+      self.users.setdefault(user,i)
+
+  ## Return the index of the first pattern matching user, or None.
+  def match(self,user):
+    best = self.users.get(user)
+    if self.any is not None and (best is None or self.any < best):
+      best = self.any
+    if self.globs:
+      if self.regex is None:
+        # the first alternative to match is the lowest index
+        self.regex = re.compile('|'.join('(%s)' % translate(g)
+                for i,g in self.globs))
+      m = self.regex.match(user)
+      if m:
+        i = self.globs[m.lastindex - 1][0]
+        if best is None or i < best: best = i
+    return best
+
+class AddrPatterns(object):
+  """Ordered list of address patterns, where the first match wins.
+
+  A pattern is user@domain, @domain or domain (any user), and the user
+  may be a glob.  A domain of *.domain matches subdomains, and * matches
+  any domain.  A leading ! makes a pattern exclude what it matches.
+  Domains are not case sensitive, localparts are.
+  >>> p = AddrPatterns(['!*-admin@example.com','@example.com',
+  ...     '*.madcowsrecord.net','bob@*','!joe@bad.example.org','*.example.org'])
+  >>> p.match('alice@example.com'), p.match('list-admin@Example.COM')
+  (True, False)
+  >>> p.match('alice@www.madcowsrecord.net'), p.match('alice@madcowsrecord.net')
+  (True, None)
+  >>> p.match('bob@example.net'), p.match('joe@bad.example.org')
+  (True, False)
+  >>> p.match('alice@bad.example.org'), p.match('example.com')
+  (True, None)
+  >>> len(p)
+  6
+  """
+
+  def __init__(self,patterns=()):
+    self.trie = {}              # reversed labels, None -> _Rules
+    self.negate = []            # pattern index -> True if exclusion
+    for pat in patterns:
+      self.add(pat)
+
+  def __len__(self):
+    return len(self.negate)
+
+  def add(self,pat):
+    i = len(self.negate)
+    neg = pat.startswith('!')
+    if neg: pat = pat[1:]
+    self.negate.append(neg)
+    user,sep,domain = pat.rpartition('@')
+    domain = domain.lower()
+    node = self.trie
+    if domain == '*':
+      labels = ['']
+    elif domain.startswith('*.'):
+      labels = domain[2:].split('.')
+      labels.reverse()
+      labels.append('')
+    else:
+      labels = reversed(domain.split('.'))
+    for label in labels:
+      node = node.setdefault(label,{})
+    rules = node.get(None)
+    if rules is None:
+      rules = node[None] = _Rules()
+    rules.add(i,user)
+
+  ## Return True if the first pattern matching addr includes it, False
+  # if it excludes it, or None if no pattern matches.
+  def match(self,addr):
+    user,sep,domain = addr.rpartition('@')
+    if not sep: return None
+    labels = domain.lower().split('.')
+    node = self.trie
+    best = None
+    for n in range(len(labels),-1,-1):
+      if n < len(labels):
+        node = node.get(labels[n])
+        if node is None: break
+      if n == 0:
+        rules = node.get(None)
+      else:
+        wild = node.get('')
+        rules = wild and wild.get(None)
+      if rules:
+        i = rules.match(user)
+        if i is not None and (best is None or i < best): best = i
+    if best is None: return None
+    return not self.negate[best]
+
+class DomainSet(object):
+  """Domain globs like fnmatchcase(), but not case sensitive.
+
+  Plain domains and *.domain go in an AddrPatterns, and only other
+  globs are tried one at a time.
+  >>> s = DomainSet(['example.com','*.example.com','mail?.example.net'])
+  >>> 'Example.COM' in s, 'a.b.example.com' in s, 'mail1.example.net' in s
+  (True, True, True)
+  >>> 'example.net' in s, 'fooexample.com' in s, len(s)
+  (False, False, 3)
+  """
+
+  def __init__(self,patterns=()):
+    self.pats = AddrPatterns()
+    self.globs = []
+    self.n = 0
+    for pat in patterns:
+      self.add(pat)
+
+  def __len__(self):
+    return self.n
+
+  def add(self,pat):
+    pat = pat.lower()
+    self.n += 1
+    if pat.startswith('*.'):
+      plain = not is_pattern(pat[2:])
+    else:
+      plain = pat == '*' or not is_pattern(pat)
+    if plain:
+      self.pats.add('@' + pat)
+    else:
+      self.globs.append(pat)
+
+  def __contains__(self,domain):
+    domain = domain.lower()
+    if self.pats.match('@' + domain):
+      return True
+    for pat in self.globs:
+      if fnmatchcase(domain,pat): return True
+    return False
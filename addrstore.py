@@ -0,0 +1,438 @@
+## @package addrstore
+# Email address list with expiration kept in an indexed database.
+#
+# Milter.cache.AddrCache reads its whole log into memory at startup, and
+# the log only grows.  AddrStore keeps the same interface, but persistent
+# entries live in sqlite (WAL mode) indexed by address and timestamp, so
+# opening it does not depend on its size, and each update is a single
+# row write.  Updates are still appended to the log file, as AddrCache
+# does, so it remains a record that can be edited or rebuilt from, and
+# lines appended to it (by hand or by an older version) are imported
+# when it is loaded.  The first load imports the
+# whole log, and later loads only read what was appended since.
+#
+# Entries with a value other than None are not persistent, just as
+# with AddrCache.  This is used to hold failed CBV results.  They are
+# kept apart from lookups, since losing one means another CBV, and
+# are dropped when they expire or, oldest first, when there are more
+# than maxsize.  Recent database lookups (including misses) are kept in
+# a bounded LRU, so memory use does not grow with the size of the
+# database.
+#
+# Nearly all lookups are for addresses that are not there.  An optional
+# BloomFilter over the database keys answers most of those without
+# touching the LRU or the database.
+#
+# Lines in the log with wildcards or a leading ! (see addrpat) are kept
+# apart from plain addresses, and compiled into an AddrPatterns that is
+# checked after the exact sender and domain.  An exclusion overrides
+# any entry for the sender.
+#
+# Author: Stuart D. Gathman <stuart@gathman.org>
+# This code is under the GNU General Public License.  See COPYING for details.
+
+import os
+import math
+import time
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from addrpat import AddrPatterns,is_pattern
+
+time_format = '%Y%b%d %H:%M:%S %Z'
+
+class BloomFilter(object):
+  """Set membership with false positives but no false negatives.
+
+  Uses -ln(error_rate)/ln(2)**2 bits per key, 9.6 bits (1.2 bytes)
+  at the default 1% error rate, or 1.2M per million keys.
+  >>> b = BloomFilter(1000)
+  >>> b.add('spammer@example.com')
+  >>> 'spammer@example.com' in b, 'friend@example.com' in b
+  (True, False)
+  >>> b.nbits, b.nhashes, len(b.bits)
+  (9586, 7, 1199)
+  """
+
+  def __init__(self,capacity,error_rate=0.01):
+    capacity = max(capacity,1)
+    self.capacity = capacity
+    self.error_rate = error_rate
+    self.nbits = int(math.ceil(-capacity*math.log(error_rate)/math.log(2)**2))
+    self.nhashes = max(1,int(round(self.nbits*math.log(2)/capacity)))
+    self.bits = bytearray((self.nbits + 7) // 8)
+    self.count = 0
+
+  # Double hashing: probe i is h1 + i*h2.
+  def _probes(self,key):
+    d = hashlib.blake2b(key.encode('utf-8','replace'),digest_size=16).digest()
+    h1 = int.from_bytes(d[:8],'little')
+    h2 = int.from_bytes(d[8:],'little') | 1
+    m = self.nbits
+    return [(h1 + i*h2) % m for i in range(self.nhashes)]
+
+  def add(self,key):
+    bits = self.bits
+    for n in self._probes(key):
+      bits[n >> 3] |= 1 << (n & 7)
+    self.count += 1
+
+  def __contains__(self,key):
+    bits = self.bits
+    for n in self._probes(key):
+      if not bits[n >> 3] & (1 << (n & 7)):
+        return False
+    return True
+
+class AddrStore(object):
+  """Map of email addresses and domains to cached results.
+
+  >>> import tempfile,shutil
+  >>> d = tempfile.mkdtemp()
+  >>> log = os.path.join(d,'test.log')
+  >>> with open(log,'w') as fp:
+  ...   print('good@example.com 2000Jan01 00:00:00 UTC',file=fp)
+  ...   print('Perm@Example.com',file=fp)
+  ...   print('example.net',file=fp)
+  >>> c = AddrStore(renew=30)
+  >>> c.load(log,age=60)
+  >>> 'perm@example.com' in c, 'anyone@example.net' in c
+  (True, True)
+  >>> 'good@example.com' in c     # expired long ago
+  False
+  >>> c['bad@example.org'] = None
+  >>> c['cbv@example.org'] = (550,'No such user')
+  >>> c['bad@example.org'], c['cbv@example.org']
+  (None, (550, 'No such user'))
+  >>> with open(log) as fp: fp.readlines()[-1].split()[0]
+  'bad@example.org'
+  >>> c.db.execute('SELECT pos FROM imported').fetchone()[0] == os.path.getsize(log)
+  True
+  >>> len(c)
+  4
+  >>> c.stats()
+  '4 entries, 7 cached, 3 hits, 6 misses (33.3%), 0 evicted'
+  >>> c.close()
+  >>> c = AddrStore(renew=30,maxsize=1)
+  >>> c.load(log,age=60)
+  >>> 'bad@example.org' in c, 'cbv@example.org' in c
+  (True, False)
+  >>> c['cbv@example.org'] = (550,'No such user')
+  >>> 'perm@example.com' in c, 'bad@example.org' in c, c.evictions
+  (True, True, 4)
+  >>> c['cbv@example.org']          # lookups don't evict results
+  (550, 'No such user')
+  >>> c['cbv2@example.org'] = (550,'No such user')
+  >>> 'cbv@example.org' in c, list(c.results)
+  (False, ['cbv2@example.org'])
+  >>> c.close()
+  >>> c = AddrStore(renew=30,bloom=True)
+  >>> c.load(log,age=60)
+  >>> 'bad@example.org' in c, 'nobody@example.org' in c, c.filtered
+  (True, False, 2)
+  >>> 'nobody@example.org' in c, c.filtered   # not cached in the LRU
+  (False, 4)
+  >>> c.close()
+  >>> with open(log,'a') as fp:
+  ...   print('!*-admin@example.com',file=fp)
+  ...   print('*.example.com',file=fp)
+  >>> c = AddrStore(renew=30)
+  >>> c.load(log,age=60)
+  >>> 'list-admin@example.com' in c, 'alice@www.example.com' in c
+  (False, True)
+  >>> 'www.example.com' in c, c['www.example.com']
+  (True, None)
+  >>> c['list-admin@example.com'] = None
+  >>> 'list-admin@example.com' in c
+  False
+  >>> c.close()
+  >>> shutil.rmtree(d)
+  """
+
+  def __init__(self,renew=7,dbname=None,maxsize=10000,bloom=False):
+    self.age = renew
+    self.maxsize = maxsize
+    self.use_bloom = bloom
+    self.bloom = None           # BloomFilter of database keys
+    # lower(sender) -> (ts,res), or None if not in the database
+    self.cache = OrderedDict()
+    # lower(sender) -> (ts,res) for non-persistent results, oldest first
+    self.results = OrderedDict()
+    self.dbname = dbname
+    self.fname = None
+    self.db = None
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.filtered = 0           # misses answered by the BloomFilter
+    self.patterns = AddrPatterns()
+
+  ## Open the database, creating it if needed.
+  def open(self,dbname=None):
+    if dbname: self.dbname = dbname
+    db = sqlite3.connect(self.dbname,check_same_thread=False,
+        isolation_level=None)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('PRAGMA synchronous=NORMAL')
+    # ts is NULL for permanent entries
+    db.execute('CREATE TABLE IF NOT EXISTS addr (addr TEXT PRIMARY KEY,ts REAL)')
+    db.execute('CREATE INDEX IF NOT EXISTS addr_ts ON addr(ts)')
+    # wildcard and exclusion entries from the log
+    db.execute('CREATE TABLE IF NOT EXISTS pattern (addr TEXT PRIMARY KEY,ts REAL)')
+    # how much of each log file has been imported
+    db.execute('''CREATE TABLE IF NOT EXISTS imported (
+        fname TEXT PRIMARY KEY,ino INTEGER,pos INTEGER)''')
+    self.db = db
+
+  def close(self):
+    with self.lock:
+      if self.db:
+        self.db.close()
+        self.db = None
+
+  ## Open the database for log fname, import lines appended to the log
+  # since the last load, and purge entries older than age days.
+  # The database is fname with a .sqlite extension unless dbname was given.
+  def load(self,fname,age=0):
+    if not age:
+      age = self.age
+    self.fname = fname
+    if not self.db:
+      self.open(self.dbname or os.path.splitext(fname)[0] + '.sqlite')
+    with self.lock:
+      self._import(fname)
+      too_old = time.time() - age*24*60*60
+      self.db.execute('DELETE FROM addr WHERE ts < ?',(too_old,))
+      self.db.execute('DELETE FROM pattern WHERE ts < ?',(too_old,))
+      self.results = OrderedDict((k,r) for k,r in self.results.items()
+          if not r[0] or r[0] > too_old)
+      self.patterns = AddrPatterns(a for a, in self.db.execute(
+        'SELECT addr FROM pattern ORDER BY rowid'))
+      if self.use_bloom:
+        self._build_bloom()
+
+  # Called with lock held.  Deleted keys stay in the filter until it
+  # is rebuilt, which only costs a database lookup.
+  def _build_bloom(self):
+    n, = self.db.execute('SELECT count(*) FROM addr').fetchone()
+    bloom = BloomFilter(max(2*n,self.maxsize))
+    for a, in self.db.execute('SELECT addr FROM addr'):
+      bloom.add(a)
+    self.bloom = bloom
+
+  def _import(self,fname):
+    try:
+      fp = open(fname,encoding='latin1')      # so tell() counts bytes
+    except (OSError,IOError):
+      return
+    with fp:
+      ino = os.fstat(fp.fileno()).st_ino
+      size = os.fstat(fp.fileno()).st_size
+      r = self.db.execute('SELECT ino,pos FROM imported WHERE fname = ?',
+        (fname,)).fetchone()
+      db = self.db
+      db.execute('BEGIN')
+      try:
+        if r and r[0] == ino and r[1] <= size:
+          fp.seek(r[1])
+        elif r:
+          # log was rewritten: manual entries may have been removed
+          db.execute('DELETE FROM addr WHERE ts IS NULL')
+          db.execute('DELETE FROM pattern')
+        partial = ''
+        for ln in iter(fp.readline,''):
+          if not ln.endswith('\n'):
+            partial = ln
+            break       # partial line still being written
+          a = ln.split(None,1)
+          if not a: continue
+          if len(a) > 1:
+            try:
+              ts = time.mktime(time.strptime(a[1].strip(),time_format))
+            except ValueError: # unparsable timestamp - likely garbage
+              continue
+          else:
+            ts = None   # manual entry
+          lsender = a[0].lower()
+          if is_pattern(lsender):
+            db.execute('INSERT OR REPLACE INTO pattern VALUES (?,?)',
+              (lsender,ts))
+          else:
+            self._put(lsender,ts)
+        pos = fp.tell() - len(partial)
+        db.execute('INSERT OR REPLACE INTO imported VALUES (?,?,?)',
+          (fname,ino,pos))
+        db.execute('COMMIT')
+      except:
+        db.execute('ROLLBACK')
+        raise
+
+  # Keep the newest timestamp, and NULL (permanent) over any timestamp.
+  def _put(self,lsender,ts):
+    self.db.execute('''INSERT INTO addr VALUES (?,?)
+      ON CONFLICT(addr) DO UPDATE SET ts = max(ts,excluded.ts)''',
+      (lsender,ts))
+    bloom = self.bloom
+    if bloom:
+      bloom.add(lsender)
+      if bloom.count > bloom.capacity:
+        self._build_bloom()
+
+  def _lookup(self,lsender):
+    with self.lock:
+      r = self.results.get(lsender)
+      if r:
+        self.hits += 1
+        return r
+      # results are not in the filter, but all database keys are
+      if self.bloom and lsender not in self.bloom:
+        self.filtered += 1
+        return None
+      try:
+        r = self.cache[lsender]
+        self.cache.move_to_end(lsender)
+        self.hits += 1
+        return r
+      except KeyError: pass
+      self.misses += 1
+      r = self.db.execute('SELECT ts FROM addr WHERE addr = ?',
+        (lsender,)).fetchone()
+      if r: r = (r[0],None)
+      self._remember(lsender,r)
+    return r
+
+  def _remember(self,lsender,r):
+    self.cache[lsender] = r
+    self.cache.move_to_end(lsender)
+    while len(self.cache) > self.maxsize:
+      self.cache.popitem(last=False)
+      self.evictions += 1
+
+  # Called with lock held.  Add a non-persistent result, then drop the
+  # oldest results while there are too many or they have expired.
+  def _keep(self,lsender,r):
+    results = self.results
+    results[lsender] = r
+    results.move_to_end(lsender)
+    too_old = time.time() - self.age*24*60*60
+    while results:
+      ts,res = next(iter(results.values()))
+      if len(results) > self.maxsize:
+        self.evictions += 1
+      elif not ts or ts > too_old:
+        break
+      results.popitem(last=False)
+
+  def _forget(self,lsender):
+    with self.lock:
+      self.results.pop(lsender,None)
+      self.cache.pop(lsender,None)
+
+  def has_precise_key(self,sender):
+    """True if precise sender is cached and has not expired.  Don't
+    try looking up wildcard entries.
+    """
+    lsender = sender and sender.lower()
+    r = self._lookup(lsender)
+    if r:
+      ts,res = r
+      too_old = time.time() - self.age*24*60*60	# max age in days
+      if not ts or ts > too_old:
+        return True
+      if res: self._forget(lsender)
+    return False
+
+  # True or False if a wildcard or exclusion matches sender, else None.
+  # A bare domain is matched as if for any user.
+  def _pattern(self,sender):
+    if not self.patterns: return None
+    if '@' not in sender: sender = '@' + sender
+    return self.patterns.match(sender.lower())
+
+  def has_key(self,sender):
+    "True if sender is cached and has not expired."
+    m = self._pattern(sender)
+    if m is False:
+      return False
+    if self.has_precise_key(sender):
+      return True
+    try:
+      user,host = sender.split('@',1)
+      if self.has_precise_key(host):
+        return True
+    except: pass
+    return bool(m)
+
+  __contains__ = has_key
+
+  def __getitem__(self,sender):
+    m = self._pattern(sender)
+    if m is not False:
+      for key in (sender,sender.partition('@')[2]):
+        if key and self.has_precise_key(key):
+          return self._lookup(key.lower())[1]
+      if m: return None
+    raise KeyError(sender)
+
+  def addperm(self,sender,res=None):
+    "Add a permanent sender."
+    lsender = sender.lower()
+    with self.lock:
+      if res:
+        self._keep(lsender,(None,res))
+        return
+      r = self.db.execute('SELECT ts FROM addr WHERE addr = ?',
+        (lsender,)).fetchone()
+      if r and r[0] is None: return     # already permanent
+      self.cache.pop(lsender,None)
+      self._put(lsender,None)
+    self._log(sender)
+
+  def __setitem__(self,sender,res):
+    lsender = sender.lower()
+    now = time.time()
+    with self.lock:
+      if res:
+        self._keep(lsender,(now,res))
+        return
+      self.results.pop(lsender,None)
+      self.cache.pop(lsender,None)
+      self._put(lsender,now)
+    self._log(sender,time.strftime(time_format,time.localtime(now)))
+
+  # Append an entry to the log file, as AddrCache does.  If the log was
+  # imported up to our line, the import offset is moved past it, since
+  # the database already has it.
+  def _log(self,*fields):
+    if not self.fname: return
+    with self.lock:
+      with open(self.fname,'a',encoding='utf-8') as fp:
+        start = fp.tell()
+        print(*fields,file=fp)
+        end = fp.tell()
+        ino = os.fstat(fp.fileno()).st_ino
+      if self.db:
+        self.db.execute('''UPDATE imported SET pos = ?
+            WHERE fname = ? AND ino = ? AND pos = ?''',
+            (end,self.fname,ino,start))
+
+  ## Number of live entries: database rows plus non-persistent results.
+  def __len__(self):
+    with self.lock:
+      n, = self.db.execute('SELECT count(*) FROM addr').fetchone()
+      n += len(self.patterns)
+      return n + len(self.results)
+
+  def stats(self):
+    "Return a one line summary for the log."
+    n = len(self)
+    total = self.hits + self.misses
+    msg = '%d entries, %d cached, %d hits, %d misses (%.1f%%), %d evicted' % (
+        n,len(self.cache) + len(self.results),self.hits,self.misses,
+        total and 100.0*self.hits/total,self.evictions)
+    if self.bloom:
+      msg += ', %d filtered, bloom %d bytes' % (
+        self.filtered,len(self.bloom.bits))
+    return msg
@@ -36,12 +36,21 @@ import urllib
 import Milter.dsn as dsn
 from Milter.dynip import is_dynip as dynip
 from Milter.utils import \
-        iniplist,parse_addr,parse_header,ip4re,addr2bin,parseaddr
+        parse_addr,parse_header,ip4re,parseaddr
 from Milter.config import MilterConfigParser
-from Milter.greysql import Greylist
-from Milter.policy import MTAPolicy
+from greyengine import GreylistEngine
+from Milter.policy import MTAPolicy,dbmopen
+from ipranges import NetIndex,IPRangeSet
+import spfcache
+import dnscache
+import accesstable
+from wordmatch import WordMatcher
+from subjectrules import SubjectRules
+from headerstore import HeaderStore
+from msgview import MessageView
+from dkimstream import BodyHashes,StreamDKIM
+from addrpat import AddrPatterns,DomainSet
 
-from fnmatch import fnmatchcase
 from glob import glob
 
 # Import gossip if available
@@ -104,14 +113,35 @@ _autopats = (
  r'^Your message\b.*\bawaits moderator approval'
 )
 reautoreply = re.compile('|'.join(_autopats),re.IGNORECASE)
+
+# Subjects of spam that claims to be legal
+ADV_PREFIXES = ("adv:","adv.","adv ",
+  "<adv>","<ad>","[adv]","(adv)","advt:","advert:","[spam]")
+ADV_SUFFIXES = ("adv","(adv)","[adv]","(non-spam)")
 import logging
 
+# Network classifications returned by Config.classify()
+NET_INTERNAL = 1
+NET_TRUSTED = 2
+NET_INTERNAL_MTA = 4
+NET_LOCALHOST = 8
+
 # Thanks to Chris Liechti for config parsing suggestions
 
 class Config(object):
   def __init__(self):
     ## True if greylisting is activated
     self.greylist = False
+    ## Milliseconds between greylist database commits.
+    self.grey_interval = 100
+    ## Greylist triplets kept in memory.
+    self.grey_cache_size = 100000
+    ## Skip greylisting for a network or SPF domain after this many of
+    # its triplets pass, or 0 to always greylist.
+    self.grey_whitelist_passes = 0
+    ## Days to skip greylisting for a proven network or domain.
+    self.grey_whitelist_days = 30
+    self.grey_engine = None
     ## List email providers which should have mailboxes banned, not domain.
     self.email_providers = (
       'yahoo.com','gmail.com','aol.com','hotmail.com','me.com',
@@ -120,6 +150,8 @@ class Config(object):
     self.access_file = None
     self.access_file_nulls = False
     self.access_file_colon = True
+    ## Load the whole access file into memory for policy lookups.
+    self.access_file_memory = False
     ## List of executable extensions to be removed from incoming emails
     # Executable email attachments is the most common Windows malware
     # vector in my experience.
@@ -144,13 +176,16 @@ class Config(object):
     ## List of networks considered internal.
     self.internal_connect = ()
     ## Banned case sensitive Subject keywords 
-    self.spam_words = ()
+    self.spam_words = WordMatcher()
     ## Banned case insensitive Subject keywords 
-    self.porn_words = ()
+    self.porn_words = WordMatcher()
     ## Banned keywords in From: header
-    self.from_words = ()
-    ## Internal senders which should whitelist recipients
-    self.whitelist_senders = {}
+    self.from_words = WordMatcher()
+    ## Extra Subject rules from the config as (name,spec,reply).
+    self.subject_config = []
+    self.subject_rules = None
+    ## Internal senders which should whitelist recipients, as AddrPatterns
+    self.whitelist_senders = AddrPatterns()
     ## Send whitelisted recipients to this MX for consolidation
     self.whitelist_mx = ()
     ## Ban these HELO names (usually local domains)
@@ -181,11 +216,29 @@ class Config(object):
     # went wrong and abort the connection.  This is currently also used 
     # when sending DSNs.
     self.timeout = 600
+    ## Messages up to this many bytes are spooled in memory.
+    # Larger messages spill to an unnamed file in tempdir.  A copy is
+    # written to tempdir when a message is defanged or crashes the milter.
+    self.spool_size = 65536
     ## List of non-SRS domains that can be trusted to forward to us.
     # If the connectip gets an SPF Pass with any of these domains,
     # we treat the email as SPF Pass for the forwarder domain.
-    # Don't make this list too long, as this is an inefficient process.
+    # Simple records are compiled to IP ranges, others are checked
+    # concurrently with the MAIL FROM query.
     self.trusted_forwarder = ()
+    ## Compiled trusted_forwarder records, or None for live queries only.
+    self.forwarder_index = None
+    ## Worker threads for concurrent SPF queries, 0 to run them serially.
+    self.spf_workers = 4
+    ## Seconds to wait for a running concurrent SPF query before it is a
+    # temperror.  Queries still waiting for a worker run serially instead.
+    self.spf_timeout = 30
+    ## Check SPF and sender reputation at the first recipient that passes
+    # local checks, instead of at MAIL FROM.
+    self.defer_spf = False
+    ## Start the HELO SPF query with MAIL FROM instead of waiting to see
+    # whether MAIL FROM passes.  Needs spf_workers.
+    self.spf_speculative_helo = False
     ## List of trusted relays such as MX hosts for our domain.
     # Connections from a trusted relay can trust the first Received header.
     # SPF checks are bypassed for internal connections and trusted relays.
@@ -230,15 +283,88 @@ class Config(object):
     # from the evil empire (and your mailboxes are not all upper case), you
     # need to set this to false.
     self.case_sensitive_localpart = False
-
+    ## Ban an entire class C when more than this many of its IPs are banned.
+    self.banned_ips_aggregate = 128
+    ## Keep the whitelist, blacklist and CBV cache in sqlite databases
+    # instead of replaying their logs at startup.
+    self.address_db = False
+    ## Maximum entries each address database keeps in memory.
+    self.address_cache_size = 10000
+    ## Put a BloomFilter in front of each address database.
+    self.address_bloom = False
+    ## Process wide cache of SPF results, or None.
+    self.spf_cache = None
+    ## Caching DNS resolver for SPF and DKIM, or None.
+    self.dns_cache = None
+    ## Warm dns_cache with likely SPF lookups at HELO.
+    self.dns_prefetch = False
+    ## DKIM key lookup through dns_cache, or None for the dkim default.
+    self.dkim_dnsfunc = None
+    ## Compiled index of internal_connect, trusted_relay and internal_mta.
+    self.netindex = None
+
+  ## Classify an IP with a single lookup in the compiled network index.
+  # The index is built on first use from internal_connect, trusted_relay,
+  # internal_mta and localhost, so read_config() builds it at startup.
+  # @return bitmask of NET_INTERNAL, NET_TRUSTED, NET_INTERNAL_MTA,
+  # NET_LOCALHOST
+  def classify(self,ipaddr):
+    netindex = self.netindex
+    if not netindex:
+      netindex = NetIndex()
+      netindex.add(NET_INTERNAL,self.internal_connect)
+      netindex.add(NET_TRUSTED,self.trusted_relay)
+      netindex.add(NET_INTERNAL_MTA,internal_mta)
+      netindex.add(NET_LOCALHOST,('127.*','::1'))
+      netindex.build()
+      self.netindex = netindex
+    return netindex.lookup(ipaddr)
+
+  ## Return the compiled SubjectRules: the built in checks in their
+  # traditional order, followed by rules from the [subject] section.
+  def getSubjectRules(self):
+    rules = self.subject_rules
+    if rules is None:
+      rules = SubjectRules()
+      spam_words,porn_words = self.spam_words,self.porn_words
+      rules.add('spam_words',lambda val,lval: spam_words.search(val))
+      if self.block_chinese:
+        # even if we wanted the Taiwanese spam, we can't read Chinese
+        rules.add('block_chinese',
+          lambda val,lval: not inCharSets(val,'iso-8859-1'),
+          ('550','5.7.1',"We don't understand that charset"))
+      # spam that claims to be legal
+      rules.add('adv',lambda val,lval: lval.startswith(ADV_PREFIXES)
+          or lval.endswith(ADV_SUFFIXES),
+        ('550','5.7.1','No soliciting allowed'))
+      rules.add('porn_words',lambda val,lval: porn_words.search(lval))
+      # annoying forwarders
+      rules.add('forward',lambda val,lval: lval.startswith(('fwd:','[fw')),
+        ('550','5.7.1','I find unedited forwards annoying'),
+        when=lambda m: not m.forward)
+      for name,spec,reply in self.subject_config:
+        rules.add_config(name,spec,reply)
+      # delayed bounce of CBV, not rejected
+      rules.add('delayed_dsn',lambda val,lval: refaildsn.search(lval),None,
+        when=lambda m: m.postmaster_reply and srs)
+      self.subject_rules = rules
+    return rules
+
+  ## Return the GreylistEngine shared by all threads, or None.
   def getGreylist(self):
     if not self.greylist: return None
-    greylist = getattr(local,'greylist',None)
+    greylist = self.grey_engine
     if not greylist:
-      grey_db = os.path.join(self.datadir,self.grey_db)
-      greylist = Greylist(grey_db,self.grey_time,
-        self.grey_expire,self.grey_days)
-      local.greylist = greylist
+      with _grey_lock:
+        greylist = self.grey_engine
+        if not greylist:
+          grey_db = os.path.join(self.datadir,self.grey_db)
+          greylist = GreylistEngine(grey_db,self.grey_time,
+            self.grey_expire,self.grey_days,
+            interval=self.grey_interval/1000.0,maxsize=self.grey_cache_size,
+            whitelist_passes=self.grey_whitelist_passes,
+            whitelist_days=self.grey_whitelist_days)
+          self.grey_engine = greylist
     return greylist
 
 config = Config()
@@ -271,7 +397,7 @@ spf_accept_softfail = ()
 spf_accept_fail = ()
 spf_reject_noptr = False
 supply_sender = False
-banned_ips = set()
+banned_ips = IPRangeSet()
 banned_domains = set()
 UNLIMITED = 0x7fffffff
 max_demerits = UNLIMITED
@@ -287,6 +413,21 @@ milter_log = logging.getLogger('milter')
 import threading
 
 local = threading.local()
+_grey_lock = threading.Lock()
+
+## Compile an address list option into AddrPatterns.
+# As with getaddrset(), file:domain names a file listing users at domain.
+def getaddrpats(cp,sect,opt):
+  pats = AddrPatterns()
+  for q in cp.getlist(sect,opt):
+    if q.startswith('file:'):
+      domain = q[5:].lower()
+      with open(domain,'r') as fp:
+        for user in fp.read().split():
+          pats.add(user + '@' + domain)
+    elif q:
+      pats.add(q)
+  return pats
 
 ## Read config files.
 # Only some configs are returned in a Config object.  Most are still
@@ -311,6 +452,11 @@ def read_config(list):
     'best_guess': 'no',
     'dspam_internal': 'yes',
     'case_sensitive_localpart': 'no',
+    'address_db': 'no',
+    'address_bloom': 'no',
+    'speculative_helo': 'no',
+    'prefetch': 'no',
+    'access_file_memory': 'no',
     'internal_policy': 'no'
   })
   try:
@@ -334,16 +480,23 @@ def read_config(list):
   global private_relay, internal_mta, max_demerits
   config.socketname = cp.get('milter','socket')
   config.timeout = cp.getintdefault('milter','timeout',600)
+  config.spool_size = cp.getintdefault('milter','spool_size',65536)
   check_user = cp.getaddrset('milter','check_user')
   config.log_headers = cp.getboolean('milter','log_headers')
   config.internal_connect = cp.getlist('milter','internal_connect')
-  internal_domains = cp.getlist('milter','internal_domains')
+  internal_domains = DomainSet(cp.getlist('milter','internal_domains'))
   config.trusted_relay = cp.getlist('milter','trusted_relay')
   private_relay = cp.getlist('milter','private_relay')
   internal_mta = cp.getlist('milter','internal_mta')
   config.hello_blacklist = cp.getlist('milter','hello_blacklist')
   config.case_sensitive_localpart = cp.getboolean('milter','case_sensitive_localpart')
   max_demerits = cp.getintdefault('milter','max_demerits',UNLIMITED)
+  config.banned_ips_aggregate = cp.getintdefault('milter',
+        'banned_ips_aggregate',128)
+  config.address_db = cp.getboolean('milter','address_db')
+  config.address_cache_size = cp.getintdefault('milter',
+        'address_cache_size',10000)
+  config.address_bloom = cp.getboolean('milter','address_bloom')
   config.errors_url = cp.get('milter','errors_url')
   if cp.has_option('milter','email_providers'):
     config.email_providers = cp.get('milter','email_providers')
@@ -362,17 +515,26 @@ def read_config(list):
   config.scan_html = cp.getboolean(section,'scan_html')
   config.block_chinese = cp.getboolean(section,'block_chinese')
   block_forward = cp.getaddrset(section,'block_forward')
-  config.porn_words = [x for x in cp.getlist(section,'porn_words') 
-        if len(x) > 1]
-  config.spam_words = [x for x in cp.getlist(section,'spam_words')
-        if len(x) > 1]
+  config.porn_words = WordMatcher(x for x in cp.getlist(section,'porn_words')
+        if len(x) > 1)
+  config.spam_words = WordMatcher(x for x in cp.getlist(section,'spam_words')
+        if len(x) > 1)
   from_words = [x for x in cp.getlist(section,'from_words')
         if len(x) > 1]
   if len(from_words) == 1 and from_words[0].startswith("file:"):
     with open(from_words[0][5:],'r') as fp:
       from_words = [s.strip() for s in fp.readlines()]
     from_words = [s for s in from_words if len(s) > 2]
-  config.from_words = from_words
+  config.from_words = WordMatcher(from_words)
+
+  # subject section
+  if cp.has_section('subject'):
+    for opt in cp.options('subject'):
+      if opt.endswith('_reply'): continue
+      config.subject_config.append((opt,cp.get('subject',opt),
+        cp.getdefault('subject',opt + '_reply')))
+    # compile now so that a bad rule is reported at startup
+    config.getSubjectRules()
 
   # scrub section
   global hide_path, internal_policy
@@ -406,7 +568,7 @@ def read_config(list):
   # dspam section
   global dspam_dict, dspam_users, dspam_userdir, dspam_exempt, dspam_internal
   global dspam_screener,dspam_whitelist,dspam_reject,dspam_sizelimit
-  config.whitelist_senders = cp.getaddrset('dspam','whitelist_senders')
+  config.whitelist_senders = getaddrpats(cp,'dspam','whitelist_senders')
   config.whitelist_mx = cp.getlist('dspam','whitelist_mx')
   dspam_dict = cp.getdefault('dspam','dspam_dict')
   dspam_exempt = cp.getaddrset('dspam','dspam_exempt')
@@ -432,7 +594,29 @@ def read_config(list):
     spf_reject_noptr = cp.getboolean('spf','reject_noptr')
     supply_sender = cp.getboolean('spf','supply_sender')
     config.access_file = cp.getdefault('spf','access_file')
+    config.access_file_memory = cp.getboolean('spf','access_file_memory')
     config.trusted_forwarder = cp.getlist('spf','trusted_forwarder')
+    cache_size = cp.getintdefault('spf','cache_size',10000)
+    if cache_size > 0:
+      config.spf_cache = spfcache.SPFCache(cache_size,
+          cp.getintdefault('spf','cache_ttl',600))
+    config.spf_workers = cp.getintdefault('spf','workers',4)
+    config.spf_timeout = cp.getintdefault('spf','timeout',30)
+    config.spf_speculative_helo = cp.getboolean('spf','speculative_helo')
+    if cp.has_option('spf','defer'):
+      config.defer_spf = cp.getboolean('spf','defer')
+    refresh = cp.getintdefault('spf','trusted_forwarder_refresh',3600)
+    if config.trusted_forwarder and refresh > 0:
+      config.forwarder_index = spfcache.ForwarderIndex(
+          config.trusted_forwarder,refresh)
+  # dns section
+  cache_size = cp.getintdefault('dns','cache_size',50000)
+  if cache_size > 0:
+    config.dns_cache = dnscache.Resolver(dnscache.default_backend(),cache_size,
+        negative_ttl=cp.getintdefault('dns','negative_ttl',300),
+        max_ttl=cp.getintdefault('dns','max_ttl',86400))
+    config.dns_prefetch = cp.getboolean('dns','prefetch')
+
   srs_config = cp.getdefault('srs','config')
   if srs_config: cp.read([srs_config])
   srs_secret = cp.getdefault('srs','secret')
@@ -483,6 +667,12 @@ def read_config(list):
     config.grey_days = cp.getintdefault('greylist','retain',36)
     config.grey_expire = cp.getintdefault('greylist','expire',6)
     config.grey_time = cp.getintdefault('greylist','time',5)
+    config.grey_interval = cp.getintdefault('greylist','commit_interval',100)
+    config.grey_cache_size = cp.getintdefault('greylist','cache_size',100000)
+    config.grey_whitelist_passes = cp.getintdefault('greylist',
+        'whitelist_passes',0)
+    config.grey_whitelist_days = cp.getintdefault('greylist',
+        'whitelist_days',30)
     config.greylist = True
 
   # DKIM section
@@ -497,6 +687,7 @@ def read_config(list):
       except:
         milter_log.error('Unable to read: %s',dkim_keyfile)
 
+  config.classify('127.0.0.1')  # compile network index now
   return config
 
 def maskip(ip):
@@ -546,9 +737,106 @@ def param2dict(str):
     if len(e) < 2: e.append(None)
   return dict([(k.upper(),v) for k,v in pairs])
 
+## Access file handles kept open across messages, one set per thread.
+# A handle is reopened when the file's inode, mtime or size changes, as
+# when makemap or postmap replaces it.  The file is checked at most once
+# per interval seconds.
+class AccessPool(object):
+
+  def __init__(self,interval=1.0):
+    self.interval = interval
+    self.local = threading.local()
+
+  def get(self,fname):
+    handles = getattr(self.local,'handles',None)
+    if handles is None:
+      handles = self.local.handles = {}
+    now = time.time()
+    h = handles.get(fname)
+    if h:
+      acf,sig,checked = h
+      if now < checked + self.interval:
+        return acf
+    try:
+      st = os.stat(fname)
+      newsig = (st.st_ino,st.st_mtime,st.st_size)
+      if h and sig == newsig:
+        handles[fname] = (acf,sig,now)
+        return acf
+      if h:
+        del handles[fname]
+        acf.close()
+      acf = dbmopen(fname,'r')
+    except:
+      print('%s: Cannot open for reading'%fname)
+      raise
+    handles[fname] = (acf,newsig,now)
+    return acf
+
+access_pool = AccessPool()
+
+## Policy tags looked up in the access file by bms.
+POLICY_TAGS = ['smtp-auth'] + [
+  '%s-%s' % (t,r) for t in ('spf','helo','dkim')
+  for r in ('pass','fail','softfail','neutral','none','permerror','temperror')
+]
+
 class SPFPolicy(MTAPolicy):
   "Get SPF/DKIM policy by result from sendmail style access file."
 
+  def __init__(self,sender,conf,access_file=None,policies=None):
+    MTAPolicy.__init__(self,sender,conf,access_file)
+    self.in_memory = conf.access_file_memory
+    self.table = None
+    ## Tag values already looked up, possibly shared for a transaction.
+    # The None key is True when all tags are present.
+    if policies is None: policies = {}
+    self.policies = policies
+
+  # use a pooled handle or compiled table instead of opening the
+  # access file every time
+  def __enter__(self):
+    self.acf = None
+    if self.access_file and not self.policies.get(None):
+      if self.in_memory:
+        self.table = accesstable.get(self.access_file,dbmopen,
+            self.use_nulls)
+      else:
+        self.acf = access_pool.get(self.access_file)
+    return self
+
+  def close(self):
+    self.acf = None
+    self.table = None
+
+  # look up pfx in the compiled table or the access file
+  def _lookup(self,pfx):
+    if self.table:
+      return self.table.getPolicy(pfx,self.sender,self.domain)
+    return MTAPolicy.getPolicy(self,pfx)
+
+  def getPolicy(self,pfx):
+    policies = self.policies
+    tag = pfx.lower().rstrip(':!')
+    if tag in policies: return policies[tag]
+    if policies.get(None): return None
+    policy = self._lookup(pfx)
+    policies[tag] = policy
+    return policy
+
+  ## Return a dict of all tags with a value for the sender.
+  # Later getPolicy() calls, possibly for other SPFPolicy objects sharing
+  # the policies, use the result.
+  def getPolicies(self):
+    policies = self.policies
+    if not policies.get(None):
+      if self.table or self.acf:
+        for tag in POLICY_TAGS:
+          if tag not in policies:
+            policies[tag] = self._lookup(tag)
+      policies[None] = True
+    return dict((k,v) for k,v in policies.items() if k and v)
+
   def getFailPolicy(self):
     policy = self.getPolicy('spf-fail')
     if not policy:
@@ -605,11 +893,21 @@ class SPFPolicy(MTAPolicy):
     return policy
 
 from Milter.cache import AddrCache
+from addrstore import AddrStore
 
 cbv_cache = AddrCache(renew=7)
 auto_whitelist = AddrCache(renew=60)
 blacklist = AddrCache(renew=30)
 
+## Return summary lines for the address caches.
+def addr_cache_report():
+  for name,c in (('auto_whitelist',auto_whitelist),('blacklist',blacklist),
+        ('cbv_cache',cbv_cache)):
+    if isinstance(c,AddrStore):
+      yield '%s: %s' % (name,c.stats())
+    else:
+      yield '%s: %d entries' % (name,len(c))
+
 def isbanned(dom,s):
   if dom in s: return True
   a = dom.split('.')
@@ -623,6 +921,23 @@ RE_MULTIMX = re.compile(r'^(mail|smtp|mx)[0-9]{1,3}[.]')
 def write_header(fp,name,val):
   fp.write(b"%s: %s\n" % (name.encode(),val.encode('utf-8')))
 
+## Decode near ascii text in a header value to unobfuscate it.
+# Values without encoded words are returned as is without parsing,
+# and decoded values are memoized in cache.
+def decode_header(hval,cache):
+  if '=?' not in hval: return hval
+  val = cache.get(hval)
+  if val is None:
+    val = cache[hval] = parse_header(hval)
+  return val
+
+## A name computed by func() when it is first formatted as a string.
+class LazyName(object):
+  def __init__(self,func):
+    self.func = func
+  def __str__(self):
+    return self.func()
+
 class bmsMilter(Milter.Base):
   """Milter to replace attachments poisonous to Windows with a WARNING message,
      check SPF, and other anti-forgery features, and implement wiretapping
@@ -648,12 +963,16 @@ class bmsMilter(Milter.Base):
     return LineWriter()
 
   def __init__(self):
-    self.tempname = None
+    self.tempname = None        # name for a saved copy of the message
+    self.savefp = None          # tempname file, until the message is saved
     self.mailfrom = None        # sender in SMTP form
     self.canon_from = None      # sender in end user form
     self.fp = None
-    self.pristine_headers = None
-    self.enhanced_headers = None
+    self.spool = None           # message as received
+    self.view = None            # MessageView of fp
+    self.body_hashes = None     # DKIM BodyHashes fed by body()
+    self.headers = None         # HeaderStore
+    self.decoded_headers = {}
     self.bodysize = 0
     self.id = Milter.uniqueID()
     self.config = config	# get reference to current global config
@@ -675,10 +994,7 @@ class bmsMilter(Milter.Base):
   # addheader can only be called from eom().  This accumulates added headers
   # which can then be applied by alter_headers()
   def add_header(self,name,val,idx=-1):
-    if idx < 0:
-      self.enhanced_headers.append((name,val))
-    else:
-      self.enhanced_headers.insert(idx,(name,val))
+    self.headers.insert(name,val,idx)
     self.new_headers.append((name,val,idx))
     self.log('%s: %s' % (name,val))
 
@@ -714,16 +1030,18 @@ class bmsMilter(Milter.Base):
     else:
       self.dport = 0
     if hostaddr and len(hostaddr) > 0:
-      config = self.config
       ipaddr = hostaddr[0]
-      if iniplist(ipaddr,config.internal_connect):
+      self.nettype = self.config.classify(ipaddr)
+      if self.nettype & NET_INTERNAL:
         self.internal_connection = True
-      if iniplist(ipaddr,config.trusted_relay):
+      if self.nettype & NET_TRUSTED:
         self.trusted_relay = True
-    else: ipaddr = ''
+    else:
+      ipaddr = ''
+      self.nettype = 0
     self.connectip = ipaddr
     self.missing_ptr = dynip(hostname,self.connectip)
-    self.localhost = iniplist(ipaddr,('127.*','::1'))
+    self.localhost = bool(self.nettype & NET_LOCALHOST)
     if self.internal_connection:
       connecttype = 'INTERNAL'
     else:
@@ -738,7 +1056,7 @@ class bmsMilter(Milter.Base):
     self.connecthost = hostname
     # Sendmail is normally configured so that only authenticated senders
     # are allowed to proceed to MAIL FROM on port 587.
-    if self.dport != 587 and addr2bin(ipaddr) in banned_ips:
+    if self.dport != 587 and ipaddr in banned_ips:
       self.log("REJECT: BANNED IP")
       return self.delay_reject('550','5.7.1', 'Banned for dictionary attacks')
     if hostname == 'localhost' and not self.localhost or hostname == '.':
@@ -765,14 +1083,37 @@ class bmsMilter(Milter.Base):
     if hostname == 'GC':
       n = gc.collect()
       self.log("gc:",n,' unreachable objects')
-      self.log("auto-whitelist:",len(auto_whitelist),' entries')
-      self.log("cbv_cache:",len(cbv_cache),' entries')
+      for line in addr_cache_report():
+        self.log(line)
+      if self.config.grey_engine:
+        self.log("greylist:",self.config.grey_engine.stats())
+      if self.config.spf_cache is not None:
+        self.log("spf_cache:",self.config.spf_cache.stats())
+      if self.config.dns_cache:
+        self.config.dns_cache.clean()
+        for line in self.config.dns_cache.report():
+          self.log("dns_cache:",line)
       self.setreply('550','5.7.1','%d unreachable objects'%n)
       return Milter.REJECT
     # HELO not allowed after MAIL FROM
     if self.mailfrom: self.offense(inc=2)
+    elif self.config.dns_prefetch and spf \
+        and not (self.internal_connection or self.trusted_relay):
+      self.prefetch_dns(hostname)
     return Milter.CONTINUE
 
+  ## Start DNS lookups that check_spf() will probably need.
+  # The HELO name records used by SPF and best guess are fetched by a
+  # pool of their own.
+  def prefetch_dns(self,hostname):
+    config = self.config
+    if not (config.dns_cache and self.connectip) \
+        or '.' not in hostname:
+      return
+    A = ':' in self.connectip and 'AAAA' or 'A'
+    queries = [(hostname,'TXT'),(hostname,A),(hostname,'MX')]
+    config.dns_cache.prefetch(dnscache.prefetch_pool(),queries)
+
   def smart_alias(self,to):
     config = self.config
     smart_alias = config.smart_alias
@@ -806,9 +1147,8 @@ class bmsMilter(Milter.Base):
       self.offenses = min
     if self.offenses > max_demerits and not self.trusted_relay:
       try:
-        ip = addr2bin(self.connectip)
-        if ip not in banned_ips:
-          banned_ips.add(ip)
+        if self.connectip not in banned_ips:
+          banned_ips.add(self.connectip)
           with open('banned_ips','at') as fp:
             print(self.connectip,file=fp)
           self.log("BANNED IP:",self.connectip)
@@ -824,11 +1164,13 @@ class bmsMilter(Milter.Base):
     #self.envid = param.get('ENVID',None)
     #self.mail_param = param
     self.fp = BytesIO()
-    self.pristine_headers = BytesIO()
-    self.enhanced_headers = []
-    if self.tempname:
-      os.remove(self.tempname)  # remove any leftover from previous message
-    self.tempname = None
+    self.headers = HeaderStore()
+    self.decoded_headers = {}   # memo for decode_header()
+    self.release_view()
+    if self.spool:
+      self.spool.close()        # discard any leftover from previous message
+      self.spool = None
+    self.discard_savename()
     self.mailfrom = f
     self.forward = True
     self.bodysize = 0
@@ -841,6 +1183,10 @@ class bmsMilter(Milter.Base):
     self.reject_spam = True
     self.data_allowed = True
     self.delayed_failure = None
+    self.srs_rcpt = False
+    self.policies = {}
+    self.sender_rc = Milter.CONTINUE    # None until deferred checks run
+    self.sender_reply = None
     self.trust_received = self.trusted_relay
     self.trust_spf = self.trusted_relay or self.internal_connection
     self.external_spf = None
@@ -860,7 +1206,7 @@ class bmsMilter(Milter.Base):
     self.arresults = []
     config = self.config
     if f == '<>' and internal_mta and self.internal_connection:
-      if not iniplist(self.connectip,internal_mta):
+      if not self.nettype & NET_INTERNAL_MTA:
         self.log("REJECT: pretend MTA at ",self.connectip,
             " sending MAIL FROM ",f)
         self.setreply('550','5.7.1',
@@ -929,10 +1275,7 @@ class bmsMilter(Milter.Base):
     self.umis = None
     if len(t) == 2:
       user,domain = t
-      for pat in internal_domains:
-        if fnmatchcase(domain,pat):
-          self.internal_domain = True
-          break
+      self.internal_domain = domain in internal_domains
       if srs and domain in srs_domain and user.lower().startswith('srs0'):
         try:
           newaddr = srs.reverse(self.canon_from)
@@ -945,7 +1288,7 @@ class bmsMilter(Milter.Base):
           return Milter.REJECT
       if self.internal_connection:
         if self.user:
-          with SPFPolicy('%s@%s'%(self.user,domain),conf=self.config) as p:
+          with self.spf_policy('%s@%s'%(self.user,domain)) as p:
             policy = p.getPolicy('smtp-auth')
             print("smtp-auth: ",p.sender,policy,p.use_nulls)
         else:
@@ -979,8 +1322,7 @@ class bmsMilter(Milter.Base):
         self.log("REJECT: banned domain",domain)
         return self.delay_reject('550','5.7.1',template='bandom',domain=domain)
       if self.internal_connection:
-        wl_users = config.whitelist_senders.get(domain,())
-        if user in wl_users or '' in wl_users:
+        if config.whitelist_senders.match(user + '@' + domain):
           self.whitelist_sender = True
           
       self.rejectvirus = domain in config.reject_virus_from
@@ -1001,6 +1343,45 @@ class bmsMilter(Milter.Base):
       return Milter.REJECT
     self.spf = None
     self.policy = None
+    self.efrom_domain = domain
+    if config.defer_spf:
+      # SPF and friends wait for a recipient that passes local checks
+      self.sender_rc = None
+      return Milter.CONTINUE
+    self.sender_rc = self.check_sender()
+    return self.sender_rc
+
+  ## Run the deferred MAIL FROM checks once per message.
+  # Later recipients get the same result and reply.
+  def sender_checks(self):
+    if self.sender_rc is None:
+      self.lastreply = None
+      self.sender_rc = self.check_sender()
+      self.sender_reply = self.lastreply
+      if self.srs_rcpt:
+        # a verified reply to our own mail overrides sender reputation
+        self.dspam = False
+        self.blacklist = False
+        self.greylist = False
+        self.delayed_failure = False
+    elif self.sender_rc != Milter.CONTINUE and self.sender_reply:
+      self.setreply(*self.sender_reply)
+    return self.sender_rc
+
+  ## Return an SPFPolicy for sender, sharing its lookups with any other
+  # SPFPolicy for the same sender in this transaction.
+  def spf_policy(self,sender):
+    policies = self.policies.setdefault(sender.lower(),{})
+    return SPFPolicy(sender,self.config,policies=policies)
+
+  ## Save the last reply so a deferred MAIL FROM rejection can be repeated.
+  def setreply(self,*args):
+    self.lastreply = args
+    return Milter.Base.setreply(self,*args)
+
+  ## SPF, whitelist, blacklist and reputation checks of MAIL FROM.
+  def check_sender(self):
+    domain = self.efrom_domain
     if not (self.internal_connection or self.trusted_relay)     \
         and self.connectip and spf:
       rc = self.check_spf()
@@ -1014,7 +1395,7 @@ class bmsMilter(Milter.Base):
         q = spf.query(self.connectip,self.canon_from,self.hello_name,
                 receiver=self.receiver,strict=False)
         q.result = 'pass'
-        with SPFPolicy(q.s,self.config) as p:
+        with self.spf_policy(q.s) as p:
           passpolicy = p.getPassPolicy()
         if self.need_cbv(passpolicy,q,'internal'):
           self.log('REJECT: internal mail from',q.s)
@@ -1044,12 +1425,13 @@ class bmsMilter(Milter.Base):
       if not self.internal_connection:
         self.offense(inc=2)
         if not dspam_userdir:
-          if domain in blacklist:
+          res = self.efrom in cbv_cache and cbv_cache[self.efrom]
+          if domain in blacklist or not res:
+            # blacklisted sender, maybe by a pattern
             self.log('REJECT: BLACKLIST',self.efrom)
             return self.delay_reject('550','5.7.1',
               'Sender email local blacklist')
           else:
-            res = cbv_cache[self.efrom]
             desc = "CBV: %d %s" % res[:2]
             self.log('REJECT:',desc)
             return self.delay_reject('550','5.7.1',*desc.splitlines())
@@ -1109,23 +1491,52 @@ class bmsMilter(Milter.Base):
         raise
     return Milter.CONTINUE
 
+  ## Evaluate an SPF query, using the shared SPF result cache if enabled.
+  def spf_check(self,q,guess=False,record=None):
+    return spfcache.check(self.config.spf_cache,q,guess,record)
+
   def check_spf(self):
     receiver = self.receiver
-    for tf in self.config.trusted_forwarder:
-      q = spf.query(self.connectip,'',tf,receiver=receiver,strict=False)
-      res,code,txt = q.check()
-      if res == 'none':
-        res,code,txt = q.best_guess('v=spf1 a mx')
-      if res == 'pass':
-        self.log("TRUSTED_FORWARDER:",tf)
-        self.whitelist = True
-        break
+    config = self.config
+    executor = config.spf_workers and spfcache.pool(config.spf_workers)
+    speculative = executor and spfcache.speculative_pool()
+    q = spf.query(self.connectip,self.canon_from,self.hello_name,
+        receiver=receiver,strict=False)
+    q.set_default_explanation(
+      'SPF fail: see http://openspf.net/why.html?sender=%s&ip=%s' % (q.s,q.c))
+    self.helo_spf = None
+    if executor and config.spf_speculative_helo and self.mailfrom != '<>':
+      h = spf.query(self.connectip,'',self.hello_name,receiver=receiver)
+      self.helo_spf = h,speculative.submit(self.spf_check,h)
+    fwd = None
+    forwarders = config.trusted_forwarder
+    if config.forwarder_index:
+      match,forwarders = config.forwarder_index.lookup(self.connectip,
+          speculative)
+      if match:
+        tf,mech = match
+        fq = spf.query(self.connectip,'',tf,receiver=receiver,strict=False)
+        fwd = fq,spfcache.compiled_pass(fq,mech)
+    mailfrom = None
+    if not fwd and forwarders:
+      fqs = [spf.query(self.connectip,'',tf,receiver=receiver,strict=False)
+        for tf in forwarders]
+      if executor:
+        # start the real MAIL FROM query while checking forwarders
+        mailfrom = executor.submit(self.spf_check,q)
+      fwd = spfcache.first_pass(config.spf_cache,fqs,executor,
+          config.spf_timeout)
+    if fwd:
+      if mailfrom: mailfrom.cancel()
+      q,(res,code,txt) = fwd
+      self.log("TRUSTED_FORWARDER:",q.h)
+      self.whitelist = True
     else:
-      q = spf.query(self.connectip,self.canon_from,self.hello_name,
-          receiver=receiver,strict=False)
-      q.set_default_explanation(
-        'SPF fail: see http://openspf.net/why.html?sender=%s&ip=%s' % (q.s,q.c))
-      res,code,txt = q.check()
+      if mailfrom:
+        res,code,txt = spfcache.result(mailfrom,config.spf_timeout,
+            lambda: self.spf_check(q))
+      else:
+        res,code,txt = self.spf_check(q)
       if authres: self.arresults.append(
         authres.SPFAuthenticationResult(result = res, result_comment = txt,
           smtp_mailfrom = self.canon_from,
@@ -1137,7 +1548,7 @@ class bmsMilter(Milter.Base):
       self.cbv_needed = (q,'permerror') # report SPF syntax error to sender
       res,code,txt = q.perm_error.ext   # extended (lax processing) result
       txt = 'EXT: ' + txt
-    with SPFPolicy(q.s,self.config) as p:
+    with self.spf_policy(q.s) as p:
       return self.check_spf_policy(p,q,res,code,txt)
 
   def check_spf_policy(self,p,q,res,code,txt):
@@ -1153,14 +1564,24 @@ class bmsMilter(Milter.Base):
         return Milter.TEMPFAIL
       res,code,txt = 'none',250,'EXT: ignoring DNS error'
     hres = None
-    if res != 'pass':
+    helo_spf,self.helo_spf = self.helo_spf,None
+    if res == 'pass':
+      if helo_spf: helo_spf[1].cancel()
+    else:
       if self.mailfrom != '<>':
         # check hello name via spf unless spf pass
-        h = spf.query(self.connectip,'',self.hello_name,receiver=self.receiver)
-        hres,hcode,htxt = h.check()
+        if helo_spf:
+          h,f = helo_spf
+          # a speculative query that never got a worker runs here
+          hres,hcode,htxt = spfcache.result(f,self.config.spf_timeout,
+              lambda: self.spf_check(h))
+        else:
+          h = spf.query(self.connectip,'',self.hello_name,
+              receiver=self.receiver)
+          hres,hcode,htxt = self.spf_check(h)
         # FIXME: in a few cases, rejecting on HELO neutral causes problems
         # for senders forced to use their braindead ISPs email service.
-        with SPFPolicy(self.hello_name,config) as hp:
+        with self.spf_policy(self.hello_name) as hp:
           policy = hp.getPolicy('helo-%s:'%hres)
         if not policy:
           if hres in ('deny','fail','neutral','softfail'):
@@ -1186,7 +1607,7 @@ class bmsMilter(Milter.Base):
           and not dynip(self.hello_name,self.connectip):
           # HELO must match more exactly.  Don't match PTR or zombies
           # will be able to get a best_guess pass on their ISPs domain.
-          hres,hcode,htxt = h.best_guess('v=spf1 a mx')
+          hres,hcode,htxt = self.spf_check(h,True,'v=spf1 a mx')
       else:
         hres,hcode,htxt = res,code,txt
       ores = res
@@ -1201,9 +1622,9 @@ class bmsMilter(Milter.Base):
         # best_guess should not result in fail
         if self.missing_ptr:
           # ignore dynamic PTR for best guess
-          res,code,txt = q.best_guess('v=spf1 a/24 mx/24')
+          res,code,txt = self.spf_check(q,True,'v=spf1 a/24 mx/24')
         else:
-          res,code,txt = q.best_guess()
+          res,code,txt = self.spf_check(q,True)
         if res != 'pass' and hres == 'pass' and spf.domainmatch([q.h],q.o):
           res = 'pass'  # get a guessed pass for valid matching HELO 
       if self.missing_ptr and ores == 'none' and res != 'pass' \
@@ -1317,6 +1738,7 @@ class bmsMilter(Milter.Base):
             self.blacklist = False
             self.greylist = False
             self.delayed_failure = False
+            self.srs_rcpt = True
           except:
             if not (self.internal_connection or self.trusted_relay):
               if srsre.match(oldaddr):
@@ -1359,6 +1781,8 @@ class bmsMilter(Milter.Base):
             gossip_node.feedback(self.umis,1)
             self.umis = None
           return self.offense()
+        rc = self.sender_checks()
+        if rc != Milter.CONTINUE: return rc
         # FIXME: should dspam_exempt be case insensitive?
         if user in block_forward.get(domain,()):
           self.forward = False
@@ -1384,6 +1808,8 @@ class bmsMilter(Milter.Base):
     except:
       self.log("rcpt to",to,str)
       raise
+    rc = self.sender_checks()
+    if rc != Milter.CONTINUE: return rc
     if self.greylist and self.config.greylist \
         and self.canon_from and not self.reject:
       # no policy for trusted or internal
@@ -1392,14 +1818,17 @@ class bmsMilter(Milter.Base):
         ip = self.spf.d
       else:
         ip = maskip(self.connectip)
-      rc = greylist.check(ip,self.canon_from,canon_to)
-      if rc == 0:
-        self.log("GREYLIST:",self.connectip,self.canon_from,canon_to)
-        self.setreply('451','4.7.1',
-          'Greylisted: http://projects.puremagic.com/greylisting/',
-          'Please retry in %.1f minutes'%(greylist.greylist_time/60.0))
-        return Milter.TEMPFAIL
-      self.log("GREYLISTED: %d"%rc)
+      if greylist.whitelisted(ip):
+        self.log("GREYLIST WHITELISTED:",ip)
+      else:
+        rc = greylist.check(ip,self.canon_from,canon_to)
+        if rc == 0:
+          self.log("GREYLIST:",self.connectip,self.canon_from,canon_to)
+          self.setreply('451','4.7.1',
+            'Greylisted: http://projects.puremagic.com/greylisting/',
+            'Please retry in %.1f minutes'%(greylist.greylist_time/60.0))
+          return Milter.TEMPFAIL
+        self.log("GREYLISTED: %d"%rc)
       
     self.log("rcpt to",to,str)
     self.smart_alias(to)
@@ -1414,75 +1843,28 @@ class bmsMilter(Milter.Base):
     lname = name.lower()
     # val is decoded header value
     if lname == 'subject':
-      
-      # check for common spam keywords
-      for wrd in config.spam_words:
-        if val.find(wrd) >= 0:
+      rule = config.getSubjectRules().match(val,self)
+      if rule:
+        if rule.reply:
           self.log('REJECT: %s: %s' % (name,val))
-          self.setreply('550','5.7.1','That subject is not allowed')
+          self.setreply(*rule.reply)
           return Milter.REJECT
-
-      # even if we wanted the Taiwanese spam, we can't read Chinese
-      if config.block_chinese:
-        if not inCharSets(val,'iso-8859-1'):
-          self.log('REJECT: %s: %s' % (name,val))
-          self.setreply('550','5.7.1',"We don't understand that charset")
-          return Milter.REJECT
-
-      # check for spam that claims to be legal
-      lval = val.lower().strip()
-      for adv in ("adv:","adv.","adv ",
-        "<adv>","<ad>","[adv]","(adv)","advt:","advert:","[spam]"):
-        if lval.startswith(adv):
-          self.log('REJECT: %s: %s' % (name,val))
-          self.setreply('550','5.7.1','No soliciting allowed')
-          return Milter.REJECT
-      for adv in ("adv","(adv)","[adv]","(non-spam)"):
-        if lval.endswith(adv):
-          self.log('REJECT: %s: %s' % (name,val))
-          self.setreply('550','5.7.1','No soliciting allowed')
-          return Milter.REJECT
-
-      # check for porn keywords
-      for w in config.porn_words:
-        if lval.find(w) >= 0:
-          self.log('REJECT: %s: %s' % (name,val))
-          self.setreply('550','5.7.1','That subject is not allowed')
-          return Milter.REJECT
-
-      # check for annoying forwarders
-      if not self.forward:
-        if lval.startswith("fwd:") or lval.startswith("[fw"):
-          self.log('REJECT: %s: %s' % (name,val))
-          self.setreply('550','5.7.1','I find unedited forwards annoying')
-          return Milter.REJECT
-
-      # check for delayed bounce of CBV
-      if self.postmaster_reply and srs:
-        if refaildsn.search(lval):
-          self.delayed_failure = val.strip()
-          # if confirmed by finding our signed Message-ID, 
-          # original sender (encoded in Message-ID) is blacklisted
+        # if confirmed by finding our signed Message-ID, 
+        # original sender (encoded in Message-ID) is blacklisted
+        self.delayed_failure = val.strip()
 
     elif lname == 'from' and self.dspam:
       fname,email = parseaddr(val)
-      for w in config.spam_words:
-        if fname.find(w) >= 0:
-          self.log('REJECT: %s: %s' % (name,val))
-          self.setreply('550','5.7.1','No soliciting')
-          return self.bandomain()
-      for w in config.from_words:
-        if fname.find(w) >= 0:
-          self.log('REJECT: %s: %s' % (name,val))
-          self.setreply('550','5.7.1','No soliciting')
-          return self.bandomain()
+      if config.spam_words.search(fname) or config.from_words.search(fname):
+        self.log('REJECT: %s: %s' % (name,val))
+        self.setreply('550','5.7.1','No soliciting')
+        return self.bandomain()
       # check for porn keywords
       lval = fname.lower().strip()
-      for w in config.porn_words:
-        if lval.find(w) >= 0:
-          self.log('REJECT: %s: %s' % (name,val))
-          self.setreply('550','5.7.1','Watch your language')
-          return self.bandomain()
+      if config.porn_words.search(lval):
+        self.log('REJECT: %s: %s' % (name,val))
+        self.setreply('550','5.7.1','Watch your language')
+        return self.bandomain()
       if email.lower().startswith('postmaster@'):
         # Yes, if From header comes last, this might not help much.
         # But this is a heuristic - if MTAs would send proper DSNs in
@@ -1566,7 +1948,7 @@ class bmsMilter(Milter.Base):
       return Milter.REJECT
     lname = name.lower()
     # decode near ascii text to unobfuscate
-    val = parse_header(hval)
+    val = decode_header(hval,self.decoded_headers)
     if not self.internal_connection and not (self.blacklist or self.whitelist):
       rc = self.check_header(name,val)
       if rc != Milter.CONTINUE:
@@ -1600,12 +1982,7 @@ class bmsMilter(Milter.Base):
       self.log('%s: %s' % (name,val.splitlines()[0]))
     # Keep both decoded and pristine headers.  DKIM needs pristine headers.
     if self.fp:
-      try:
-        write_header(self.fp,name,val)     # add decoded header to buffer
-      except:
-        write_header(self.fp,name,hval)     # add decoded header to buffer
-      self.enhanced_headers.append((name,val))
-      write_header(self.pristine_headers,name,hval)
+      self.headers.add(name,hval,val)
     return Milter.CONTINUE
 
   ## Get email text exactly as it came from the MTA.
@@ -1613,26 +1990,43 @@ class bmsMilter(Milter.Base):
   # encoding, since spammers use this to obfuscate their message.
   # DKIM on the other hand, needs pristine headers to compute the message hash.
   def get_pristine_txt(self):
-    self.fp.seek(self.body_start)
-    return self.pristine_headers.getvalue()+b'\n'+self.fp.read()
+    return self.message_view().text(self.headers.pristine())
 
   ## Get email text with original headers unobfuscated.
+  # @return a read only memoryview of the spool
   def get_decoded_txt(self):
-    self.fp.seek(0)
-    return self.fp.read()
+    return self.message_view().buf
 
   ## Get email text with unobfuscated and additional headers.
   # We add headers for authentication and SPF results, which should
   # be included when spam checking for enhanced accuracy.
   def get_enhanced_txt(self):
-    s = ''.join('%s: %s\n' % (name,val) for name,val in self.enhanced_headers)
-    self.fp.seek(self.body_start)
-    return s.encode('utf8')+b'\n'+self.fp.read()
+    return self.message_view().text(self.headers.enhanced())
+
+  ## Size of get_enhanced_txt() without building it.
+  def enhanced_size(self):
+    return self.message_view().size(self.headers.enhanced())
+
+  ## Return a MessageView of the body in fp without copying it.
+  # The view is kept until fp is replaced.
+  def message_view(self):
+    v = self.view
+    if not v or v.fp is not self.fp:
+      self.release_view()
+      v = self.view = MessageView(self.fp,self.body_start)
+    return v
+
+  ## Release the MessageView, if any, so the spool can be closed.
+  def release_view(self):
+    if self.view:
+      self.view.release()
+      self.view = None
 
   def eoh(self):
     if not self.fp: return Milter.TEMPFAIL      # not seen by envfrom
     if self.data() == Milter.REJECT:
       return Milter.REJECT
+    self.fp.write(self.headers.decoded())       # add decoded headers to buffer
     for name,val,idx in self.new_headers:
       write_header(self.fp,name,val)            # add new headers to buffer
     self.fp.write(b'\n')                        # terminate headers
@@ -1667,15 +2061,26 @@ class bmsMilter(Milter.Base):
             self.log("NOTE: Supplying MFROM as Sender");
             self.add_header('Sender',self.mailfrom)
       del msg
-    # copy headers to a temp file for scanning the body
+    # copy headers to a spool for scanning the body, which stays in
+    # memory unless the message is large
     self.fp.seek(0)
     headers = self.fp.getvalue()
     self.fp.close()
-    fd,fname = tempfile.mkstemp(".defang")
-    self.tempname = fname
-    self.fp = os.fdopen(fd,"w+b")
+    self.spool = tempfile.SpooledTemporaryFile(self.config.spool_size)
+    self.fp = self.spool
     self.fp.write(headers)      # IOError (e.g. disk full) causes TEMPFAIL
     self.body_start = self.fp.tell()
+    # hash the body for DKIM as it arrives
+    self.body_hashes = None
+    if StreamDKIM:
+      if self.internal_connection:
+        if self.config.dkim_key:
+          self.body_hashes = BodyHashes()
+          self.body_hashes.add(b'simple')
+      elif self.has_dkim:
+        self.body_hashes = BodyHashes()
+        for val in self.headers.raw('dkim-signature'):
+          self.body_hashes.add_signature(val)
     # check if headers are really spammy
     if dspam_dict and not self.internal_connection and dspam_dict.index('/')<0:
       ds = Dspam.DSpamDirectory(dspam_userdir)
@@ -1700,6 +2105,8 @@ class bmsMilter(Milter.Base):
       if self.fp:
         self.fp.write(chunk)      # IOError causes TEMPFAIL in milter
         self.bodysize += len(chunk)
+        if self.body_hashes:
+          self.body_hashes.update(chunk)
     except Exception as x:
       if not self.ioerr:
         self.ioerr = x
@@ -1725,15 +2132,52 @@ class bmsMilter(Milter.Base):
     return None
 
     
+  ## Return the name the original message is saved as if defanged.
+  # The file is created empty, so that the name is ours, and is not
+  # written until save_message().
+  def savename(self):
+    if not self.tempname:
+      fd,self.tempname = tempfile.mkstemp(".defang")
+      self.savefp = os.fdopen(fd,'wb')
+    return self.tempname
+
+  ## Remove the savename() file if the message was not saved in it.
+  def discard_savename(self):
+    if self.savefp:
+      self.savefp.close()
+      self.savefp = None
+      os.remove(self.tempname)
+    self.tempname = None
+
+  ## Write the message as received to a new file in tempdir.
+  # The spool is only in memory or an unnamed file, so this is
+  # how failed and defanged messages are kept for diagnosis.
+  # @param suffix for a new file, or None for the savename() file
+  # @return the filename
+  def save_message(self,suffix=None):
+    if suffix:
+      fd,fname = tempfile.mkstemp(suffix)
+      fp = os.fdopen(fd,'wb')
+    else:
+      fname = self.savename()
+      fp,self.savefp = self.savefp,None
+      if not fp: return fname   # already saved
+    with fp:
+      self.spool.seek(0)
+      shutil.copyfileobj(self.spool,fp)
+    return fname
+
   def _chk_attach(self,msg):
     "Filter attachments by content."
     config = self.config
+    # the saved copy is only created if a warning quotes its name
+    savname = LazyName(self.savename)
     # check for bad extensions
-    mime.check_name(msg,self.tempname,ckname=self._chk_ext,
+    mime.check_name(msg,savname,ckname=self._chk_ext,
        scan_zip=config.scan_zip)
     # remove scripts from HTML
     if config.scan_html:
-      mime.check_html(msg,self.tempname)        
+      mime.check_html(msg,savname)
     # don't let a tricky virus slip one past us
     if config.scan_rfc822:
       submsg = msg.get_submsg()
@@ -1778,10 +2222,17 @@ class bmsMilter(Milter.Base):
     elif config.dkim_domain:
       domain = config.dkim_domain
     if config.dkim_key and domain == config.dkim_domain:
-      txt = self.get_pristine_txt()
       try:
-        d = dkim.DKIM(txt,logger=milter_log)
-        h = d.sign(config.dkim_selector,domain,config.dkim_key,
+        hasher = self.body_hashes and self.body_hashes.get(b'simple',b'rsa-sha256')
+        if hasher:
+          d = StreamDKIM(self.headers.pristine()+b'\n',self.body_hashes,
+                logger=milter_log)
+          h = d.sign_hashed(config.dkim_selector.encode(),domain.encode(),
+                config.dkim_key.encode(),hasher).decode()
+        else:
+          txt = self.get_pristine_txt()
+          d = dkim.DKIM(txt,logger=milter_log)
+          h = d.sign(config.dkim_selector,domain,config.dkim_key,
                 canonicalize=('relaxed','simple'))
         name,val = h.split(':',1)
         self.addheader(name,val.strip().replace('\r\n','\n'),0)
@@ -1791,12 +2242,19 @@ class bmsMilter(Milter.Base):
         milter_log.error("sign_dkim: %s",x,exc_info=True)
       
   def check_dkim(self):
-      txt = self.get_pristine_txt()
       res = False
       result = 'error'
-      d = dkim.DKIM(txt,logger=milter_log,minkey=768)
+      if self.body_hashes:
+        # body already hashed, only the headers are needed
+        d = StreamDKIM(self.headers.pristine()+b'\n',self.body_hashes,
+                logger=milter_log,minkey=768)
+      else:
+        d = dkim.DKIM(self.get_pristine_txt(),logger=milter_log,minkey=768)
       try:
-        res = d.verify()
+        if self.config.dkim_dnsfunc:
+          res = d.verify(dnsfunc=self.config.dkim_dnsfunc)
+        else:
+          res = d.verify()
         if res:
           dkim_comment = 'Good %d bit signature.' % d.keysize
           result = 'pass'
@@ -1824,7 +2282,7 @@ class bmsMilter(Milter.Base):
       if not res:
         fd,fname = tempfile.mkstemp(".dkim")
         with os.fdopen(fd,"w+b") as fp:
-          fp.write(txt)
+          fp.write(self.get_pristine_txt())
         self.log('DKIM: Fail (saved as %s)'%fname)
       return result
 
@@ -1968,10 +2426,11 @@ class bmsMilter(Milter.Base):
     # screen if no recipients are dspam_users
     if not modified and dspam_screener and not self.internal_connection \
         and self.dspam:
-      txt = self.get_enhanced_txt()
-      if len(txt) > dspam_sizelimit:
-        self.log("Large message:",len(txt))
+      size = self.enhanced_size()
+      if size > dspam_sizelimit:
+        self.log("Large message:",size)
         return False
+      txt = self.get_enhanced_txt()
       screener = dspam_screener[self.id % len(dspam_screener)]
       if not ds.check_spam(screener,txt,self.recipients,
         classify=True,quarantine=False):
@@ -2035,10 +2494,11 @@ class bmsMilter(Milter.Base):
     if not dspam_screener: return
     ds = Dspam.DSpamDirectory(dspam_userdir)
     ds.log = self.log
-    txt = self.get_enhanced_txt()
-    if len(txt) > dspam_sizelimit:
-      self.log("Large message:",len(txt))
+    size = self.enhanced_size()
+    if size > dspam_sizelimit:
+      self.log("Large message:",size)
       return
+    txt = self.get_enhanced_txt()
     screener = dspam_screener[self.id % len(dspam_screener)]
     # since message will be rejected, we do not quarantine
     ds.check_spam(screener,txt,self.recipients,force_result=dspam.DSR_ISSPAM,
@@ -2073,9 +2533,7 @@ class bmsMilter(Milter.Base):
     whitelisted = []
     for canon_to in self.recipients:
       user,domain = canon_to.split('@')
-      for pat in internal_domains:
-        if fnmatchcase(domain,pat): break
-      else:
+      if domain not in internal_domains:
         auto_whitelist[canon_to] = None
         whitelisted.append(canon_to)
         self.log('Auto-Whitelist:',canon_to)
@@ -2084,9 +2542,12 @@ class bmsMilter(Milter.Base):
   def eom(self):
     config = self.config
     if self.ioerr:
-      fname = tempfile.mktemp(".ioerr")  # save message that caused crash
-      os.rename(self.tempname,fname)
-      self.tempname = None
+      try:
+        # save message that caused crash
+        fname = self.save_message(".ioerr")
+        self.log('Saved as',fname)
+      except EnvironmentError as x:
+        self.log('Save failed:',x)
       return Milter.TEMPFAIL
     if not self.fp:
       self.apply_headers()
@@ -2108,20 +2569,17 @@ class bmsMilter(Milter.Base):
           blacklist[sender] = None
           try:
             # save message for debugging
-            fname = tempfile.mktemp(".dsn")
-            os.rename(self.tempname,fname)
-          except:
-            fname = self.tempname
-          self.tempname = None
+            fname = self.save_message(".dsn")
+          except EnvironmentError:
+            fname = None
           self.log('BLACKLIST:',sender,fname)
           return Milter.DISCARD
       
       if not self.internal_connection and self.has_dkim:
         res = self.check_dkim()
         if self.dkim_domain and not self.whitelist:
-          p = SPFPolicy(self.dkim_domain,self.config)
-          policy = p.getPolicy('dkim-%s:'%res)
-          p.close()
+          with self.spf_policy(self.dkim_domain) as p:
+            policy = p.getPolicy('dkim-%s:'%res)
           if policy == 'REJECT':
             self.log('REJECT: DKIM',res,self.dkim_domain)
             self.setreply('550','5.7.1','DKIM %s for %s'%(res,self.dkim_domain))
@@ -2165,9 +2623,12 @@ class bmsMilter(Milter.Base):
           self.setreply('450','4.2.0',
                 'Too busy discarding spam.  Please try again later.')
           return Milter.TEMPFAIL
-      fname = tempfile.mktemp(".fail")  # save message that caused crash
-      os.rename(self.tempname,fname)
-      self.tempname = None
+      try:
+        # save message that caused crash
+        fname = self.save_message(".fail")
+      except EnvironmentError as x:
+        self.log('Save failed:',x)
+        fname = None
       if exc_type == errors.BoundaryError:
         milter_log.warn("MALFORMED: %s",fname)  # log filename
         if self.internal_connection:
@@ -2249,19 +2710,15 @@ class bmsMilter(Milter.Base):
         _archive_lock = thread.allocate_lock()
       _archive_lock.acquire()
       try:
-        fin = open(self.tempname,'r')
-        fout = open(config.mail_archive,'a')
-        shutil.copyfileobj(fin,fout,8192)
+        with open(config.mail_archive,'ab') as fout:
+          self.spool.seek(0)
+          shutil.copyfileobj(self.spool,fout,8192)
       finally:
         _archive_lock.release()
-        fin.close()
-        fout.close()
       
     if not defanged and not spam_checked:
       if gossip and self.umis and self.screened:
         gossip_node.feedback(self.umis,0)
-      os.remove(self.tempname)
-      self.tempname = None      # prevent re-removal
       self.log("eom")
       return rc                 # no modified attachments
 
@@ -2271,10 +2728,10 @@ class bmsMilter(Milter.Base):
         self.log("REJECT virus from",self.mailfrom)
         self.setreply('550','5.7.1','Attachment type not allowed.',
                 'You attempted to send an attachment with a banned extension.')
-        self.tempname = None
+        self.save_message()
         return Milter.REJECT
-      self.log("Temp file:",self.tempname)
-      self.tempname = None      # prevent removal of original message copy
+      # keep original message copy
+      self.log("Temp file:",self.save_message())
     out = tempfile.TemporaryFile()
     try:
       msg.dump(out)
@@ -2384,8 +2841,11 @@ class bmsMilter(Milter.Base):
     return Milter.CONTINUE
 
   def close(self):
-    if self.tempname:
-      os.remove(self.tempname)  # remove in case session aborted
+    self.release_view()
+    if self.spool:
+      self.spool.close()        # in case session aborted
+      self.spool = None
+    self.discard_savename()
     if self.fp:
       self.fp.close()
     
@@ -2414,16 +2874,24 @@ def main():
       print("chdir:",config.logdir)
       os.chdir(config.logdir)
 
+  global cbv_cache,auto_whitelist,blacklist
+  if config.address_db:
+    # lines appended to the logs are imported by load()
+    n,bloom = config.address_cache_size,config.address_bloom
+    cbv_cache = AddrStore(renew=cbv_cache.age,maxsize=n,bloom=bloom)
+    auto_whitelist = AddrStore(renew=auto_whitelist.age,maxsize=n,bloom=bloom)
+    blacklist = AddrStore(renew=blacklist.age,maxsize=n,bloom=bloom)
   cbv_cache.load('send_dsn.log',age=30)
   auto_whitelist.load('auto_whitelist.log',age=120)
   blacklist.load('blacklist.log',age=60)
 
   try:
     global banned_ips
-    banned_ips = set(addr2bin(ip) 
-        for fn in glob('banned_ips*')
-        for ip in open(fn))
-    print(len(banned_ips),'banned ips')
+    # banned_ips.bin caches the parsed text files for a fast restart
+    banned_ips = IPRangeSet(config.banned_ips_aggregate).load_files(
+        [fn for fn in glob('banned_ips*') if '.bin' not in fn],
+        'banned_ips.bin')
+    print(len(banned_ips),'banned ip ranges')
   except:
     milter_log.exception('Error reading banned_ips')
 
@@ -2438,8 +2906,8 @@ def main():
 
   greylist = config.getGreylist()
   if greylist:
-    print("Expired %d greylist records." % greylist.clean())
-    greylist.close()
+    # expired records are deleted in the background, and daily after that
+    greylist.start_expire()
 
   if config.from_words:
     print("%d from words banned" % len(config.from_words))
@@ -2453,8 +2921,25 @@ def main():
     flags = flags + Milter.DELRCPT
   Milter.set_flags(flags)
   socket.setdefaulttimeout(60)
+  if config.dns_cache:
+    if spf:
+      dnscache.install_spf(config.dns_cache)
+      if config.spf_cache is not None:
+        config.spf_cache.resolver = config.dns_cache
+    if dkim:
+      config.dkim_dnsfunc = dnscache.dkim_dnsfunc(config.dns_cache)
   milter_log.info("bms milter startup")
   Milter.runmilter("pythonfilter",config.socketname,config.timeout)
+  for line in addr_cache_report():
+    milter_log.info(line)
+  if config.grey_engine:
+    config.grey_engine.close()
+    milter_log.info("greylist: %s",config.grey_engine.stats())
+  if config.spf_cache is not None:
+    milter_log.info("spf_cache: %s",config.spf_cache.stats())
+  if config.dns_cache:
+    for line in config.dns_cache.report():
+      milter_log.info("dns_cache: %s",line)
   milter_log.info("bms milter shutdown")
   # force dereference of local data structures before shutdown
   getattr(local, 'whatever', None)
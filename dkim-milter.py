@@ -19,6 +19,7 @@ import os
 import tempfile
 import StringIO
 import re
+import dnscache
 from Milter.config import MilterConfigParser
 from Milter.utils import iniplist,parse_addr,parseaddr
 
@@ -42,6 +43,15 @@ def read_config(list):
   conf.socketname = cp.getdefault('milter','socketname', '/tmp/dkimmiltersock')
   conf.miltername = cp.getdefault('milter','name','pydkimfilter')
   conf.internal_connect = cp.getlist('milter','internal_connect')
+  # DNS cache for keys and ADSP
+  conf.dns_cache = None
+  conf.dnsfunc = get_txt
+  cache_size = cp.getintdefault('dns','cache_size',50000)
+  if cache_size > 0:
+    conf.dns_cache = dnscache.Resolver(dnscache.default_backend(),cache_size,
+        negative_ttl=cp.getintdefault('dns','negative_ttl',300),
+        max_ttl=cp.getintdefault('dns','max_ttl',86400))
+    conf.dnsfunc = dnscache.dkim_dnsfunc(conf.dns_cache)
   # DKIM section
   if cp.has_option('dkim','privkey'):
     conf.keyfile = cp.getdefault('dkim','privkey')
@@ -159,7 +169,7 @@ class dkimMilter(Milter.Base):
     adsp = { 'dkim': 'unknown' }
     if self.author:
       author_domain = self.author.split('@',1)[-1]
-      s = get_txt('_adsp._domainkey.'+author_domain)
+      s = self.conf.dnsfunc('_adsp._domainkey.'+author_domain)
       if s:
         m = parse_tag_value(s)
         if m.has_key('dkim'):
@@ -230,7 +240,7 @@ class dkimMilter(Milter.Base):
       conf = self.conf
       d = dkim.DKIM(txt,logger=conf.log)
       try:
-        res = d.verify()
+        res = d.verify(dnsfunc=conf.dnsfunc)
         if res:
           self.dkim_comment = 'Good %d bit signature.' % d.keysize
         else:
@@ -269,4 +279,7 @@ See the sendmail README for libmilter.
 sample dkim-milter startup""" % (miltername,miltername,socketname)
   sys.stdout.flush()
   Milter.runmilter(miltername,socketname,240)
+  if config.dns_cache:
+    for line in config.dns_cache.report():
+      config.log.info('dns_cache: %s',line)
   print "sample dkim-milter shutdown"
@@ -0,0 +1,250 @@
+## @package dkimstream
+# DKIM body hashes computed as the body arrives.
+#
+# dkimpy canonicalizes and hashes the whole body when a signature is
+# verified or made, which puts all of that work in eom().  A BodyHasher
+# canonicalizes each body() chunk as it comes, so eom() only has to
+# hash the headers and check or make the signature.  StreamDKIM is
+# given just the headers, and takes the body hash from the BodyHashes
+# fed during body().
+#
+# Author: Stuart D. Gathman <stuart@gathman.org>
+# This code is under the GNU General Public License.  See COPYING for details.
+
+import re
+import time
+import base64
+import hashlib
+
+try:
+  import dkim
+  from dkim.util import parse_tag_value
+  from dkim.crypto import parse_pem_private_key
+  from dkim.canonicalization import CanonicalizationPolicy
+  # needs the DomainSigner methods of dkimpy 1.0
+  if not (hasattr(dkim.DKIM,'verify_sig') and hasattr(dkim.DKIM,'gen_header')):
+    dkim = None
+except ImportError:
+  dkim = None
+
+HASHES = {
+  b'rsa-sha256': hashlib.sha256,
+  b'rsa-sha1': hashlib.sha1,
+  b'ed25519-sha256': hashlib.sha256
+}
+
+CRLF = b'\r\n'
+RE_EOL = re.compile(br'\r?\n')
+RE_TRAILING_WSP = re.compile(br'[\t ]+\r\n')
+RE_WSP = re.compile(br'[\t ]+')
+
+class BodyHasher(object):
+  """Canonicalize and hash a message body a chunk at a time.
+
+  >>> def bh(s): return base64.b64encode(hashlib.sha256(s).digest())
+  >>> h = BodyHasher(b'relaxed')
+  >>> h.update(b'Hello  \\tworld \\r\\n\\r')
+  >>> h.update(b'\\n \\r\\n\\r\\n')
+  >>> h.bodyhash() == bh(b'Hello world\\r\\n')
+  True
+  >>> h = BodyHasher(b'simple',length=3)
+  >>> h.update(b'Hello\\n\\n')
+  >>> h.bodyhash() == bh(b'Hel'), h.count
+  (True, 3)
+  >>> BodyHasher().bodyhash() == bh(b'\\r\\n')
+  True
+  """
+
+  def __init__(self,canon=b'simple',algorithm=b'rsa-sha256',length=None):
+    if canon not in (b'simple',b'relaxed'):
+      raise ValueError('Unknown body canonicalization: %r' % canon)
+    self.canon = canon
+    self.relaxed = canon == b'relaxed'
+    self.algorithm = algorithm
+    self.hash = HASHES[algorithm]()
+    self.length = length        # l= limit on canonical body bytes hashed
+    self.count = 0              # canonical body bytes hashed
+    self.partial = b''          # incomplete last line
+    self.blank = 0              # empty lines held back, maybe trailing
+    self.started = False        # body has a non empty line
+    self.digested = None
+
+  def _emit(self,data):
+    if self.length is not None:
+      data = data[:max(self.length - self.count,0)]
+    self.count += len(data)
+    self.hash.update(data)
+
+  ## Hash complete lines, holding back empty lines that may be trailing.
+  def _lines(self,block):
+    block = RE_EOL.sub(CRLF,block)
+    if self.relaxed:
+      block = RE_WSP.sub(b' ',RE_TRAILING_WSP.sub(CRLF,block))
+    k = len(block)
+    while k >= 4 and block[k-4:k] == b'\r\n\r\n':
+      k -= 2
+    if k == 2 and block.startswith(CRLF):
+      self.blank += len(block)//2
+      return
+    if self.blank:
+      self._emit(CRLF * self.blank)
+    self._emit(block[:k])
+    self.blank = (len(block) - k)//2
+    self.started = True
+
+  def update(self,chunk):
+    data = self.partial + chunk
+    i = data.rfind(b'\n') + 1
+    self.partial = data[i:]
+    if i:
+      self._lines(data[:i])
+
+  ## Finish the body and return the raw digest.
+  def digest(self):
+    if self.digested is None:
+      # dkimpy ends an unterminated last line without stripping it
+      line = self.partial
+      if self.relaxed:
+        line = RE_WSP.sub(b' ',line)
+      if line:
+        self._emit(CRLF * self.blank + line + CRLF)
+        self.started = True
+      if not self.started and not self.relaxed:
+        self._emit(CRLF)
+      self.digested = self.hash.digest()
+    return self.digested
+
+  ## Return the base64 digest, as in the bh= tag.
+  def bodyhash(self):
+    return base64.b64encode(self.digest())
+
+class BodyHashes(object):
+  """The body hashes needed for a message, fed together.
+
+  >>> b = BodyHashes()
+  >>> b.add_signature('v=1; a=rsa-sha256; c=relaxed/relaxed; d=example.com;'
+  ...    ' s=sel; h=from; bh=xxx; b=yyy')
+  True
+  >>> b.add_signature('v=1; a=rsa-sha256; c=relaxed/junk')
+  False
+  >>> b.update(b'Hi\\r\\n')
+  >>> h = b.get(b'relaxed',b'rsa-sha256')
+  >>> h.count, len(b)
+  (4, 1)
+  """
+
+  def __init__(self):
+    self.hashers = {}
+
+  def __len__(self):
+    return len(self.hashers)
+
+  def add(self,canon=b'simple',algorithm=b'rsa-sha256',length=None):
+    key = (canon,algorithm,length)
+    h = self.hashers.get(key)
+    if h is None:
+      h = self.hashers[key] = BodyHasher(canon,algorithm,length)
+    return h
+
+  ## Add the body hash for a DKIM-Signature header value.
+  # @return False if the signature can't be parsed
+  def add_signature(self,val):
+    if isinstance(val,str):
+      val = val.encode('utf8')
+    try:
+      sig = parse_tag_value(val)
+      canon,algorithm,length = sig_body(sig)
+      self.add(canon,algorithm,length)
+    except Exception:
+      return False
+    return True
+
+  def get(self,canon,algorithm,length=None):
+    return self.hashers.get((canon,algorithm,length))
+
+  def update(self,chunk):
+    for h in self.hashers.values():
+      h.update(chunk)
+
+## Return the body canonicalization, algorithm and length of a signature.
+def sig_body(sig):
+  c = sig.get(b'c',b'simple/simple').split(b'/')
+  canon = c[1] if len(c) > 1 else b'simple'
+  length = sig.get(b'l')
+  if length is not None:
+    length = int(length)
+  if canon not in (b'simple',b'relaxed') or sig[b'a'] not in HASHES:
+    raise ValueError('Unsupported signature: %r' % sig)
+  return canon,sig[b'a'],length
+
+if dkim:
+  class StreamDKIM(dkim.DKIM):
+    "DKIM for a message given as headers, with its body already hashed."
+
+    ## @param headers the message headers and blank line
+    # @param bodyhashes BodyHashes fed the body
+    def __init__(self,headers,bodyhashes,**kw):
+      dkim.DKIM.__init__(self,headers,**kw)
+      self.bodyhashes = bodyhashes
+
+    def verify_sig(self,sig,include_headers,sig_header,dnsfunc):
+      if b'bh' in sig:
+        try:
+          h = self.bodyhashes.get(*sig_body(sig))
+        except ValueError as x:
+          raise dkim.MessageFormatError(str(x))
+        if h is None:
+          raise dkim.MessageFormatError('body not hashed')
+        try:
+          bh = base64.b64decode(re.sub(br"\s+", b"", sig[b'bh']))
+        except TypeError as x:
+          raise dkim.MessageFormatError(str(x))
+        if h.digest() != bh:
+          raise dkim.ValidationError(
+              "body hash mismatch (got %s, expected %s)" %
+              (h.bodyhash(), sig[b'bh']))
+        # body checked, dkimpy need only check the headers
+        sig = dict(sig)
+        del sig[b'bh']
+      return dkim.DKIM.verify_sig(self,sig,include_headers,sig_header,dnsfunc)
+
+    ## Sign with relaxed headers and a hashed body, like DKIM.sign().
+    # Only RSA keys are supported.
+    # @param hasher a BodyHasher for rsa-sha256 or rsa-sha1
+    def sign_hashed(self,selector,domain,privkey,hasher,identity=None,
+        include_headers=None):
+      self.signature_algorithm = hasher.algorithm
+      self.hasher = HASHES[hasher.algorithm]
+      try:
+        pk = parse_pem_private_key(privkey)
+      except dkim.UnparsableKeyError as x:
+        raise dkim.KeyFormatError(str(x))
+      canon_policy = CanonicalizationPolicy.from_c_value(
+          b'relaxed/' + hasher.canon)
+      if include_headers is None:
+        include_headers = self.default_sign_headers()
+      include_headers = tuple(x.lower() for x in include_headers)
+      self.include_headers = include_headers
+      if b'from' not in include_headers:
+        raise dkim.ParameterError("The From header field MUST be signed")
+      sigfields = [
+        (b'v', b"1"),
+        (b'a', hasher.algorithm),
+        (b'c', canon_policy.to_c_value()),
+        (b'd', domain),
+        (b'i', identity or b"@"+domain),
+        (b'q', b"dns/txt"),
+        (b's', selector),
+        (b't', str(int(time.time())).encode('ascii')),
+        (b'h', b" : ".join(include_headers)),
+        (b'bh', hasher.bodyhash()),
+        (b'b', b'0'*60),
+      ]
+      res = self.gen_header(sigfields, include_headers, canon_policy,
+          b"DKIM-Signature", pk)
+      self.domain = domain
+      self.selector = selector
+      self.signature_fields = dict(sigfields)
+      return b'DKIM-Signature: ' + res
+else:
+  StreamDKIM = None
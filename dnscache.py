@@ -0,0 +1,288 @@
+## @package dnscache
+# Caching DNS resolver shared by the milters.
+#
+# SPF, DKIM and ADSP checks each resolve the same names over and over,
+# and every spf.query starts with an empty cache.  Resolver keeps
+# answers for their DNS TTL, remembers NXDOMAIN and NODATA answers,
+# and lets concurrent threads asking the same question wait for a
+# single query.  Hit rates and query latency are kept by record type.
+#
+# install_spf() replaces spf.DNSLookup, and Resolver.get_txt() can be
+# passed as dnsfunc to dkim.
+#
+# Author: Stuart D. Gathman <stuart@gathman.org>
+# This code is under the GNU General Public License.  See COPYING for details.
+
+import time
+import importlib.util
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+## Raised by backends for DNS failures that should be retried later.
+class DNSError(Exception): pass
+
+## Upper bounds in milliseconds of the latency histogram buckets.
+LATENCY_BUCKETS = (1,5,10,25,50,100,250,500,1000,2500,5000,None)
+
+## Prefetches queued or running beyond which more are dropped.
+MAX_PREFETCH = 8
+
+_prefetch_pool = None
+_prefetch_lock = threading.Lock()
+
+## Return the process wide pool for prefetch().  It is kept apart from
+# the SPF workers, so prefetches never delay a real check.
+def prefetch_pool(workers=2):
+  global _prefetch_pool
+  with _prefetch_lock:
+    if _prefetch_pool is None:
+      _prefetch_pool = ThreadPoolExecutor(max_workers=workers)
+    return _prefetch_pool
+
+class TypeStats(object):
+  "Counters for one record type."
+
+  def __init__(self):
+    self.hits = 0
+    self.negative = 0           # hits on cached NXDOMAIN or NODATA
+    self.misses = 0
+    self.shared = 0             # answered by another thread's query
+    self.errors = 0
+    self.latency = [0]*len(LATENCY_BUCKETS)
+
+  def record(self,secs):
+    ms = secs * 1000
+    for i,b in enumerate(LATENCY_BUCKETS):
+      if b is None or ms <= b:
+        self.latency[i] += 1
+        break
+
+  def __str__(self):
+    total = self.hits + self.misses + self.shared
+    hist = ' '.join('<%s:%d' % (b or 'inf',n)
+        for b,n in zip(LATENCY_BUCKETS,self.latency) if n)
+    return '%d queries, %d hits (%d negative), %d shared, %d misses, ' \
+        '%d errors, %.1f%% hit; ms %s' % (
+        total,self.hits,self.negative,self.shared,self.misses,self.errors,
+        total and 100.0*(self.hits+self.shared)/total,hist)
+
+class _Flight(object):
+  "A query in progress that other threads can wait for."
+  def __init__(self):
+    self.event = threading.Event()
+    self.values = None
+    self.error = None
+
+class Resolver(object):
+  """TTL cache in front of a DNS backend.
+
+  A backend is called as backend(name,qtype,timeout) and returns
+  (values,ttl), where ttl may be None if unknown.
+  >>> calls = []
+  >>> def backend(name,qtype,timeout):
+  ...   calls.append(name)
+  ...   if name.lower() == 'example.com': return [(b'v=spf1 -all',)],60
+  ...   return [],None
+  >>> r = Resolver(backend)
+  >>> r.lookup('Example.COM','TXT')
+  [(('Example.COM', 'TXT'), (b'v=spf1 -all',))]
+  >>> r.get_txt(b'example.com.')
+  b'v=spf1 -all'
+  >>> r.lookup('nx.example.com','TXT'), r.lookup('nx.example.com','TXT')
+  ([], [])
+  >>> calls
+  ['Example.COM', 'nx.example.com']
+  >>> st = r.stats['TXT']; st.hits, st.negative, st.misses
+  (2, 1, 2)
+  """
+
+  def __init__(self,backend,maxsize=50000,negative_ttl=300,
+        default_ttl=300,max_ttl=86400):
+    self.backend = backend
+    self.maxsize = maxsize
+    self.negative_ttl = negative_ttl
+    self.default_ttl = default_ttl
+    self.max_ttl = max_ttl
+    self.cache = OrderedDict()          # (name,qtype) -> (expires,values)
+    self.pending = {}                   # (name,qtype) -> _Flight
+    self.lock = threading.Lock()
+    self.stats = {}                     # qtype -> TypeStats
+    self.local = threading.local()
+    self.prefetching = 0                # prefetches queued or running
+    self.dropped = 0                    # prefetches dropped when busy
+
+  ## Start tracking the smallest TTL of answers used by this thread.
+  def mark(self):
+    self.local.ttl = None
+
+  ## Smallest remaining TTL of answers used by this thread since mark().
+  def min_ttl(self):
+    return getattr(self.local,'ttl',None)
+
+  def _used(self,ttl):
+    t = getattr(self.local,'ttl',None)
+    if t is None or ttl < t:
+      self.local.ttl = ttl
+
+  ## Return [((name,qtype),value)] like spf.DNSLookup.
+  def lookup(self,name,qtype,timeout=30):
+    key = (name.lower().rstrip('.'),qtype)
+    now = time.time()
+    with self.lock:
+      st = self.stats.get(qtype)
+      if st is None:
+        st = self.stats[qtype] = TypeStats()
+      r = self.cache.get(key)
+      if r and r[0] > now:
+        expires,values = self.cache.pop(key)
+        self.cache[key] = r           # most recently used
+        st.hits += 1
+        if not values: st.negative += 1
+        self._used(int(expires - now))
+        return [((name,qtype),v) for v in values]
+      flight = self.pending.get(key)
+      leader = flight is None
+      if leader:
+        flight = self.pending[key] = _Flight()
+        st.misses += 1
+      else:
+        st.shared += 1
+    if not leader:
+      flight.event.wait(timeout)
+      if flight.error: raise flight.error
+      if flight.values is None:
+        raise DNSError('Timeout waiting for %s %s' % (name,qtype))
+      return [((name,qtype),v) for v in flight.values]
+    try:
+      try:
+        values,ttl = self.backend(name,qtype,timeout)
+      except Exception as x:
+        flight.error = x
+        with self.lock: st.errors += 1
+        raise
+      if ttl is None:
+        ttl = values and self.default_ttl or self.negative_ttl
+      ttl = min(ttl,self.max_ttl)
+      elapsed = time.time() - now
+      with self.lock:
+        st.record(elapsed)
+        if ttl > 0:
+          self.cache.pop(key,None)
+          self.cache[key] = (now + ttl,values)
+          while len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
+      self._used(ttl)
+      flight.values = values
+    finally:
+      with self.lock:
+        del self.pending[key]
+      flight.event.set()
+    return [((name,qtype),v) for v in values]
+
+  ## Look up (name,qtype) pairs in the background to warm the cache.
+  # Names already cached are skipped, and errors are ignored.  When
+  # max_pending prefetches are already waiting, the rest are dropped.
+  def prefetch(self,executor,queries,max_pending=MAX_PREFETCH):
+    now = time.time()
+    for name,qtype in queries:
+      r = self.cache.get((name.lower().rstrip('.'),qtype))
+      if r and r[0] > now: continue
+      with self.lock:
+        if self.prefetching >= max_pending:
+          self.dropped += 1
+          continue
+        self.prefetching += 1
+      executor.submit(self._prefetch,name,qtype)
+
+  def _prefetch(self,name,qtype):
+    try:
+      self.lookup(name,qtype)
+    except Exception: pass
+    finally:
+      with self.lock:
+        self.prefetching -= 1
+
+  ## Return the first TXT record for name joined as bytes, or None.
+  # Same interface as dkim.dnsplug.get_txt.
+  def get_txt(self,name,timeout=5):
+    if isinstance(name,bytes):
+      try: name = name.decode('UTF-8')
+      except UnicodeDecodeError: return None
+    for k,v in self.lookup(name,'TXT',timeout):
+      return b''.join(v)
+    return None
+
+  ## Drop expired entries.
+  def clean(self):
+    now = time.time()
+    with self.lock:
+      for key in [k for k,(exp,v) in self.cache.items() if exp <= now]:
+        del self.cache[key]
+
+  ## Return a list of summary lines for the log.
+  def report(self):
+    with self.lock:
+      return ['%d entries, %d prefetches dropped' % (
+          len(self.cache),self.dropped)] + [
+        '%s: %s' % (qtype,st) for qtype,st in sorted(self.stats.items())]
+
+## Backend using dnspython, which supplies TTLs.
+def dnspython_backend(name,qtype,timeout):
+  import dns.resolver
+  import dns.exception
+  resolve = getattr(dns.resolver,'resolve',None) or dns.resolver.query
+  try:
+    a = resolve(name,qtype,raise_on_no_answer=False,lifetime=timeout)
+  except dns.resolver.NXDOMAIN:
+    return [],None
+  except dns.exception.Timeout as x:
+    raise DNSError('DNS ' + str(x))
+  except dns.resolver.NoNameservers as x:
+    raise DNSError('DNS ' + str(x))
+  values = []
+  for rdata in a.rrset or ():
+    if qtype in ('A','AAAA'):
+      values.append(rdata.address)
+    elif qtype == 'MX':
+      values.append((rdata.preference,rdata.exchange.to_text(True)))
+    elif qtype == 'PTR':
+      values.append(rdata.target.to_text(True))
+    elif qtype in ('TXT','SPF'):
+      values.append(tuple(rdata.strings))
+  return values,max(0,int(a.expiration - time.time()))
+
+## Adapt an spf.DNSLookup style function as a backend without TTLs.
+def lookup_backend(func):
+  def backend(name,qtype,timeout):
+    return [v for (n,t),v in func(name,qtype,timeout=timeout)
+        if t == qtype],None
+  return backend
+
+## Return dnspython_backend if available, else the current spf.DNSLookup.
+def default_backend():
+  if importlib.util.find_spec('dns') is not None:
+    return dnspython_backend
+  import spf
+  return lookup_backend(spf.DNSLookup)
+
+## Route pyspf lookups through resolver.
+def install_spf(resolver):
+  import spf
+  def DNSLookup(name,qtype,strict=True,timeout=30):
+    try:
+      return resolver.lookup(name,qtype,timeout)
+    except DNSError as x:
+      raise spf.TempError(str(x))
+  spf.DNSLookup = DNSLookup
+  return DNSLookup
+
+## Return a dkim dnsfunc that looks up keys through resolver.
+def dkim_dnsfunc(resolver):
+  import dkim
+  def get_txt(name,timeout=5):
+    try:
+      return resolver.get_txt(name,timeout)
+    except DNSError as x:
+      raise dkim.DnsTimeoutError(str(x))
+  return get_txt
@@ -0,0 +1,331 @@
+## @package greyengine
+# Greylist with an in-memory cache and a single batching writer.
+#
+# Milter.greysql.Greylist opens a database per milter thread and commits
+# a transaction for every recipient, so busy threads contend for the
+# database lock.  GreylistEngine is shared by all threads.  Recently
+# seen triplets are answered from memory, and updates are queued for
+# one writer thread that commits them together every interval.  Retries
+# of triplets that already passed only update lastseen on disk once per
+# write_slack seconds.
+#
+# The database has the same table as Milter.greysql, and check() gives
+# the same answers.
+#
+# Bulk senders pass greylisting again for every new recipient.  After
+# whitelist_passes triplets from the same network or SPF domain have
+# passed, whitelisted() is true for it for whitelist_days, and callers
+# can skip check().  Proven networks are kept in memory and saved in
+# the greylist_subnet table.
+#
+# start_expire() deletes expired records in a background thread, a
+# batch of rowids at a time, so a large database doesn't hold up startup
+# or lock out the writer.
+#
+# Author: Stuart D. Gathman <stuart@gathman.org>
+# This code is under the GNU General Public License.  See COPYING for details.
+
+import time
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict
+
+log = logging.getLogger('milter.greylist')
+
+class GreylistEngine(object):
+  """Greylist triplets cached in memory and written in batches.
+
+  >>> import tempfile,shutil,os
+  >>> d = tempfile.mkdtemp()
+  >>> g = GreylistEngine(os.path.join(d,'greylist.db'),grey_time=5,interval=0.01)
+  >>> g.check('192.0.2.0','a@example.com','b@example.org')
+  0
+  >>> g.check('192.0.2.0','a@example.com','b@example.org',timeinc=6*60)
+  1
+  >>> g.check('192.0.2.0','a@example.com','b@example.org',timeinc=7*60)
+  2
+  >>> g.misses, g.hits
+  (1, 2)
+  >>> g.close()
+  >>> g = GreylistEngine(os.path.join(d,'greylist.db'),grey_time=5)
+  >>> g.check('192.0.2.0','a@example.com','b@example.org',timeinc=8*60)
+  2
+  >>> g.close()
+  >>> g = GreylistEngine(os.path.join(d,'greylist.db'),grey_time=5,
+  ...     whitelist_passes=2)
+  >>> for rcpt in ('c@example.org','d@example.org'):
+  ...   g.whitelisted('example.com'),g.check('example.com','a@example.com',rcpt)
+  ...   g.check('example.com','a@example.com',rcpt,timeinc=6*60)
+  (False, 0)
+  1
+  (False, 0)
+  1
+  >>> g.whitelisted('example.com')
+  True
+  >>> g.close()
+  >>> g = GreylistEngine(os.path.join(d,'greylist.db'))
+  >>> g.whitelisted('example.com'), g.whitelisted('example.net')
+  (True, False)
+  >>> g.expire(batch=1,pause=0,timeinc=40*24*3600)[0]
+  3
+  >>> g.close()
+  >>> shutil.rmtree(d)
+  """
+
+  def __init__(self,dbname,grey_time=10,grey_expire=4,grey_retain=36,
+        interval=0.1,maxsize=100000,write_slack=3600,
+        whitelist_passes=0,whitelist_days=30):
+    self.greylist_time = grey_time * 60         # minutes
+    self.greylist_expire = grey_expire * 3600   # hours
+    self.greylist_retain = grey_retain * 24 * 3600   # days
+    self.dbname = dbname
+    self.interval = interval            # seconds between commits
+    self.maxsize = maxsize
+    self.write_slack = write_slack
+    self.whitelist_passes = whitelist_passes
+    self.whitelist_time = whitelist_days * 24 * 3600
+    # (ip,sender,rcpt) -> [firstseen,lastseen,cnt,lastseen on disk]
+    self.cache = OrderedDict()
+    self.pending = {}                   # (ip,sender,rcpt) -> row to write
+    self.writing = {}                   # rows being committed
+    # ip -> [passes,whitelisted until,last pass]
+    self.subnets = {}
+    self.pending_subnets = {}           # ip -> row to write
+    self.lock = threading.Lock()
+    self.wakeup = threading.Condition(self.lock)
+    self.hits = 0
+    self.misses = 0
+    self.writes = 0
+    self.commits = 0
+    self.skipped = 0                    # checks skipped for proven ips
+    self.conn = self._connect()
+    self.conn.execute('''create table if not exists greylist(
+        ip text , sender text, recipient text,
+        firstseen timestamp, lastseen timestamp, cnt integer, umis text,
+        primary key (ip,sender,recipient))''')
+    self.conn.execute('''create table if not exists greylist_subnet(
+        ip text primary key, passes integer, until timestamp,
+        lastseen timestamp)''')
+    for row in self.conn.execute(
+        'select ip,passes,until,lastseen from greylist_subnet'):
+      self.subnets[row[0]] = list(row[1:])
+    self.running = True
+    self.stopped = threading.Event()
+    self.expire_thread = None
+    self.writer = threading.Thread(target=self._write_loop,
+        name='greylist writer')
+    self.writer.daemon = True
+    self.writer.start()
+
+  def _connect(self):
+    conn = sqlite3.connect(self.dbname,timeout=30,check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+  # Called with lock held.
+  def _get(self,key):
+    r = self.cache.get(key)
+    if r:
+      self.cache.move_to_end(key)
+      self.hits += 1
+      return r
+    self.misses += 1
+    # evicted triplets may not be on disk yet
+    row = self.pending.get(key) or self.writing.get(key)
+    if not row:
+      row = self.conn.execute('''select firstseen,lastseen,cnt from greylist
+        where ip=? and sender=? and recipient=?''',key).fetchone()
+    if row:
+      r = [row[0],row[1],row[2],row[1]]
+    else:
+      r = [None,None,0,None]
+    self.cache[key] = r
+    while len(self.cache) > self.maxsize:
+      self.cache.popitem(last=False)
+    return r
+
+  ## True if ip (a network or SPF domain) has passed greylisting often
+  # enough to skip check().
+  def whitelisted(self,ip,timeinc=0):
+    r = self.subnets.get(ip)
+    if r and r[1] and r[1] > time.time() + timeinc:
+      self.skipped += 1
+      return True
+    return False
+
+  # Called with lock held when a triplet first passes.
+  def _passed(self,ip,now):
+    r = self.subnets.get(ip)
+    if not r:
+      r = self.subnets[ip] = [0,None,now]
+    elif r[1] and r[1] < now:
+      r[:2] = [0,None]          # whitelisting expired, start over
+    r[0] += 1
+    r[2] = now
+    if r[0] >= self.whitelist_passes and not r[1]:
+      r[1] = now + self.whitelist_time
+      log.info('Greylist whitelisted: %s',ip)
+    if not (self.pending or self.pending_subnets):
+      self.wakeup.notify()
+    self.pending_subnets[ip] = tuple(r)
+
+  def check(self,ip,sender,recipient,timeinc=0):
+    "Return number of allowed messages for greylist triple."
+    key = (ip,sender,recipient)
+    now = time.time() + timeinc
+    with self.lock:
+      r = self._get(key)
+      firstseen,lastseen,cnt,stored = r
+      passed = cnt
+      if firstseen is None:
+        r[:3] = now,now,0
+      elif now > lastseen + self.greylist_retain:
+        # expired
+        log.debug('Expired greylist: %s:%s:%s',ip,sender,recipient)
+        r[:3] = now,now,0
+      elif now < firstseen + self.greylist_time + 5:
+        # still greylisted
+        log.debug('Early greylist: %s:%s:%s',ip,sender,recipient)
+        r[1] = now
+      elif cnt or now < firstseen + self.greylist_expire:
+        # in greylist window or active
+        r[1:3] = now,cnt + 1
+        log.debug('Active greylist(%d): %s:%s:%s',cnt+1,ip,sender,recipient)
+      else:
+        # passed greylist window
+        log.debug('Late greylist: %s:%s:%s',ip,sender,recipient)
+        r[:3] = now,now,0
+      if r[2] == 1 and self.whitelist_passes:
+        self._passed(ip,now)
+      # a triplet that already passed only needs lastseen kept current
+      # enough for the retention limit
+      if not (passed and r[2] and stored and now < stored + self.write_slack):
+        r[3] = now
+        if not (self.pending or self.pending_subnets):
+          self.wakeup.notify()
+        self.pending[key] = tuple(r[:3])
+      return r[2]
+
+  # Commit whatever is pending, then let more collect for an interval.
+  def _write_loop(self):
+    conn = self._connect()
+    while True:
+      with self.lock:
+        while self.running and not (self.pending or self.pending_subnets):
+          self.wakeup.wait()
+        pending,self.pending = self.pending,{}
+        subnets,self.pending_subnets = self.pending_subnets,{}
+        self.writing = pending
+        running = self.running
+      if pending or subnets:
+        try:
+          self._write(conn,pending,subnets)
+        except Exception:
+          log.exception('Greylist write failed')
+        with self.lock:
+          self.writing = {}
+      if not running: break
+      time.sleep(self.interval)
+    conn.close()
+
+  def _write(self,conn,pending,subnets={}):
+    with conn:
+      conn.executemany('''insert or replace into
+        greylist_subnet(ip,passes,until,lastseen) values(?,?,?,?)''',
+        [(k,) + v for k,v in subnets.items()])
+      conn.executemany('''insert into
+        greylist(ip,sender,recipient,firstseen,lastseen,cnt,umis)
+        values(?,?,?,?,?,?,NULL)
+        on conflict(ip,sender,recipient) do update set
+        firstseen=excluded.firstseen,lastseen=excluded.lastseen,
+        cnt=excluded.cnt''',
+        [k + v for k,v in pending.items()])
+    with self.lock:
+      self.writes += len(pending)
+      self.commits += 1
+
+  def clean(self,timeinc=0):
+    "Delete records past the retention limit."
+    now = time.time() + timeinc - self.greylist_retain
+    with self.lock:
+      with self.conn:
+        cnt = self.conn.execute('delete from greylist where lastseen < ?',
+            (now,)).rowcount
+      self._expire_memory(self.conn,now,timeinc)
+    return cnt
+
+  # Called with lock held.  Drop expired triplets from the cache, and
+  # networks that stopped sending and are no longer whitelisted.
+  def _expire_memory(self,conn,cutoff,timeinc):
+    for key in [k for k,r in self.cache.items() if r[1] and r[1] < cutoff]:
+      del self.cache[key]
+    t = time.time() + timeinc
+    with conn:
+      conn.execute('''delete from greylist_subnet
+        where lastseen < ? and (until is null or until < ?)''',(cutoff,t))
+    for ip in [ip for ip,r in self.subnets.items()
+          if r[2] < cutoff and not (r[1] and r[1] > t)]:
+      del self.subnets[ip]
+
+  ## Delete records past the retention limit in batches of rowids,
+  # pausing between batches.  Returns (records deleted,seconds).
+  def expire(self,batch=1000,pause=0.05,timeinc=0):
+    start = time.time()
+    cutoff = start + timeinc - self.greylist_retain
+    conn = self._connect()
+    cnt = 0
+    try:
+      lo,hi = conn.execute('select min(rowid),max(rowid) from greylist'
+          ).fetchone()
+      while lo is not None and lo <= hi and self.running:
+        with conn:
+          cnt += conn.execute('''delete from greylist
+            where rowid >= ? and rowid < ? and lastseen < ?''',
+            (lo,lo + batch,cutoff)).rowcount
+        lo += batch
+        if pause: self.stopped.wait(pause)
+      with self.lock:
+        self._expire_memory(conn,cutoff,timeinc)
+    finally:
+      conn.close()
+    elapsed = time.time() - start
+    log.info('Expired %d greylist records in %.1f seconds',cnt,elapsed)
+    return cnt,elapsed
+
+  ## Run expire() in a background thread now, and then every interval
+  # seconds until close().
+  def start_expire(self,interval=86400,batch=1000,pause=0.05):
+    def run():
+      while self.running:
+        try:
+          self.expire(batch,pause)
+        except Exception:
+          log.exception('Greylist expire failed')
+        if self.stopped.wait(interval): break
+    t = threading.Thread(target=run,name='greylist expire')
+    t.daemon = True
+    t.start()
+    self.expire_thread = t
+    return t
+
+  ## Write pending updates and stop the writer thread.
+  def close(self):
+    with self.lock:
+      self.running = False
+      self.wakeup.notify()
+    self.stopped.set()
+    self.writer.join()
+    if self.expire_thread:
+      self.expire_thread.join()
+    self.conn.close()
+
+  def stats(self):
+    "Return a one line summary for the log."
+    total = self.hits + self.misses
+    return '%d cached, %d hits, %d misses (%.1f%%), %d writes in %d commits, ' \
+        '%d checks skipped for %d whitelisted' % (
+        len(self.cache),self.hits,self.misses,total and 100.0*self.hits/total,
+        self.writes,self.commits,self.skipped,
+        sum(1 for r in self.subnets.values() if r[1]))
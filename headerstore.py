@@ -0,0 +1,100 @@
+## @package headerstore
+# Message headers kept once and serialized on demand.
+#
+# The milter needs the headers three ways: decoded for content filters,
+# pristine for DKIM, and "enhanced" (decoded plus the headers we add)
+# for spam classification.  HeaderStore keeps each header once as the
+# value from the MTA, plus the decoded value only when decoding changed
+# it, and builds each serialization when asked.  A serialization is
+# kept until the headers change, so it is the same object each time.
+#
+# Author: Stuart D. Gathman <stuart@gathman.org>
+# This code is under the GNU General Public License.  See COPYING for details.
+
+class HeaderStore(object):
+  """Headers as received, with decoded and added views.
+
+  >>> h = HeaderStore()
+  >>> h.add('Subject','=?utf-8?q?Hi?=','Hi')
+  >>> h.add('To','bob@example.com','bob@example.com')
+  >>> h.insert('Received-SPF','pass',0)
+  >>> h.insert('X-Note','added')
+  >>> h.pristine()
+  b'Subject: =?utf-8?q?Hi?=\\nTo: bob@example.com\\n'
+  >>> h.decoded()
+  b'Subject: Hi\\nTo: bob@example.com\\n'
+  >>> h.enhanced()
+  b'Received-SPF: pass\\nSubject: Hi\\nTo: bob@example.com\\nX-Note: added\\n'
+  >>> len(h), h.enhanced() is h.enhanced(), h.raw('subject')
+  (2, True, ['=?utf-8?q?Hi?='])
+  """
+
+  def __init__(self):
+    self.headers = []           # (name,hval,val or None if same as hval)
+    self.order = []             # index into headers, or added (name,val)
+    self.cache = {}             # serializations since the last change
+
+  def __len__(self):
+    return len(self.headers)
+
+  ## Add a header from the MTA.
+  # @param hval value as received
+  # @param val decoded value
+  def add(self,name,hval,val):
+    self.cache.clear()
+    self.order.append(len(self.headers))
+    self.headers.append((name,hval,None if val == hval else val))
+
+  ## Add a header of our own to the enhanced view.
+  # @param idx position, or -1 to append
+  def insert(self,name,val,idx=-1):
+    self.cache.clear()
+    if idx < 0:
+      self.order.append((name,val))
+    else:
+      self.order.insert(idx,(name,val))
+
+  ## Return the values of a header as received.
+  def raw(self,name):
+    name = name.lower()
+    return [hval for n,hval,val in self.headers if n.lower() == name]
+
+  def pristine(self):
+    s = self.cache.get('pristine')
+    if s is None:
+      s = self.cache['pristine'] = self._pristine()
+    return s
+
+  def _pristine(self):
+    return b''.join(b'%s: %s\n' % (name.encode(),hval.encode('utf-8'))
+        for name,hval,val in self.headers)
+
+  def _decoded(self,name,hval,val):
+    if val is not None:
+      try:
+        return b'%s: %s\n' % (name.encode(),val.encode('utf-8'))
+      except UnicodeError: pass
+    return b'%s: %s\n' % (name.encode(),hval.encode('utf-8'))
+
+  def decoded(self):
+    s = self.cache.get('decoded')
+    if s is None:
+      s = self.cache['decoded'] = b''.join(
+          self._decoded(*h) for h in self.headers)
+    return s
+
+  def enhanced(self):
+    s = self.cache.get('enhanced')
+    if s is None:
+      s = self.cache['enhanced'] = self._enhanced()
+    return s
+
+  def _enhanced(self):
+    a = []
+    for h in self.order:
+      if isinstance(h,tuple):
+        a.append('%s: %s\n' % h)
+      else:
+        name,hval,val = self.headers[h]
+        a.append('%s: %s\n' % (name,hval if val is None else val))
+    return ''.join(a).encode('utf8')
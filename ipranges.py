@@ -0,0 +1,398 @@
+## @package ipranges
+# Sorted interval tables of IP addresses.
+#
+# The iniplist() function in Milter.utils rescans a list of CIDR and glob
+# patterns on every call.  That is fine for a handful of entries, but
+# internal_connect and trusted_relay lists with hundreds of relay ranges
+# are checked on every connection.  NetIndex compiles such lists once
+# into sorted, disjoint intervals that are searched with bisect.
+#
+# IPRangeSet holds banned IPs the same way, in arrays of integers
+# rather than a set of objects, with a binary cache that can be mapped
+# at startup instead of parsing millions of lines of text.
+#
+# Author: Stuart D. Gathman <stuart@gathman.org>
+# This code is under the GNU General Public License.  See COPYING for details.
+
+import os
+import mmap
+import socket
+import struct
+import ipaddress
+from array import array
+from bisect import bisect_right
+from fnmatch import fnmatchcase
+
+## Convert an iniplist() style pattern to an ip_network, or None.
+# Trailing wildcard octets of an IP4 glob (e.g. 192.168.*) are converted
+# to the equivalent CIDR.  Patterns that are neither IP nor convertible
+# globs return None.
+def pattern2net(pat):
+  """Convert an iniplist pattern to a network.
+  >>> pattern2net('66.179.26.128/26')
+  IPv4Network('66.179.26.128/26')
+  >>> pattern2net('127.*')
+  IPv4Network('127.0.0.0/8')
+  >>> pattern2net('192.168.0.*')
+  IPv4Network('192.168.0.0/24')
+  >>> pattern2net('2001:610:779::/48')
+  IPv6Network('2001:610:779::/48')
+  >>> pattern2net('192.168.1?.*')
+  """
+  try:
+    return ipaddress.ip_network(pat,strict=False)
+  except ValueError: pass
+  a = pat.split('.')
+  if len(a) > 4: return None
+  while a and a[-1] == '*': a.pop()
+  if len(a) == 4 or not a or len(a) == len(pat.split('.')): return None
+  if not all(x.isdigit() for x in a): return None
+  n = len(a)*8
+  a += ['0']*(4 - len(a))
+  try:
+    return ipaddress.ip_network('%s/%d' % ('.'.join(a),n))
+  except ValueError:
+    return None
+
+class NetIndex(object):
+  """Classify IP addresses by tag with a single bisect per lookup.
+
+  Each tag is an int bit, and lookup returns the bitwise OR of the
+  tags of all lists containing the address.
+  >>> ni = NetIndex()
+  >>> ni.add(1,['192.168.0.0/16','127.*'])
+  >>> ni.add(2,['192.168.5.*','2001:db8::/32'])
+  >>> ni.lookup('192.168.5.1')
+  3
+  >>> ni.lookup('192.168.6.1')
+  1
+  >>> ni.lookup('2001:db8::1')
+  2
+  >>> ni.lookup('10.1.1.1')
+  0
+  """
+
+  def __init__(self):
+    self.ranges = { 4: [], 6: [] }      # (first,last,tag) by IP version
+    self.globs = []                     # (pattern,tag) not convertible
+    self.index = None
+
+  ## Add an iniplist() style list of patterns under tag.
+  # Hostnames are resolved now, rather than on every lookup as with
+  # iniplist(), so the index must be rebuilt to pick up DNS changes.
+  def add(self,tag,iplist):
+    for pat in iplist:
+      p = pat.split('/',1)
+      net = pattern2net(pat)
+      if net:
+        self.ranges[net.version].append(
+          (int(net.network_address),int(net.broadcast_address),tag))
+      elif '*' in pat or '?' in pat or '[' in pat:
+        self.globs.append((pat,tag))
+      else:
+        sfx = '/'.join(['']+p[1:])
+        try:
+          addrs = set(r[4][0] for r in socket.getaddrinfo(p[0],25))
+        except socket.gaierror: continue
+        self.add(tag,[a+sfx for a in addrs])
+    self.index = None
+
+  ## Merge overlapping ranges into sorted disjoint intervals.
+  def build(self):
+    index = {}
+    for ver,ranges in self.ranges.items():
+      events = []
+      for first,last,tag in ranges:
+        events.append((first,tag,1))
+        events.append((last+1,tag,-1))
+      events.sort()
+      starts,masks = [],[]
+      counts = {}
+      i = 0
+      while i < len(events):
+        pos = events[i][0]
+        while i < len(events) and events[i][0] == pos:
+          _,tag,inc = events[i]
+          counts[tag] = counts.get(tag,0) + inc
+          i += 1
+        mask = 0
+        for tag,cnt in counts.items():
+          if cnt > 0: mask |= tag
+        if masks and masks[-1] == mask: continue
+        starts.append(pos)
+        masks.append(mask)
+      index[ver] = (starts,masks)
+    self.index = index
+    return index
+
+  ## Return the OR of tags for all lists containing ipaddr.
+  # Raises ValueError for invalid IP syntax, like iniplist().
+  def lookup(self,ipaddr):
+    index = self.index or self.build()
+    try:
+      ip = ipaddress.ip_address(ipaddr)
+    except ValueError:
+      raise ValueError('Invalid ip syntax:'+ipaddr)
+    starts,masks = index[ip.version]
+    i = bisect_right(starts,int(ip)) - 1
+    mask = masks[i] if i >= 0 else 0
+    for pat,tag in self.globs:
+      if not mask & tag and fnmatchcase(ipaddr,pat):
+        mask |= tag
+    return mask
+
+## Insert the range first..last into sorted disjoint starts/ends arrays,
+# merging with overlapping or adjacent ranges.
+def _insert(starts,ends,first,last):
+  i = bisect_right(starts,first)
+  if i > 0 and ends[i-1] + 1 >= first:
+    i -= 1
+    first = starts[i]
+    last = max(last,ends[i])
+  j = i
+  while j < len(starts) and starts[j] <= last + 1:
+    last = max(last,ends[j])
+    j += 1
+  starts[i:j] = array(starts.typecode,(first,))
+  ends[i:j] = array(ends.typecode,(last,))
+
+## Sum the number of addresses in ranges overlapping first..last.
+def _coverage(starts,ends,first,last):
+  i = max(bisect_right(starts,first) - 1,0)
+  cnt = 0
+  while i < len(starts) and starts[i] <= last:
+    cnt += max(0,min(ends[i],last) - max(starts[i],first) + 1)
+    i += 1
+  return cnt
+
+class IPRangeSet(object):
+  """Compact set of banned IPs stored as sorted integer ranges.
+
+  IP4 addresses are kept as 32-bit ranges, and a class C with more than
+  agg4 banned addresses is banned as a whole, as ban2zone.py does.
+  IP6 bans are always by /64 prefix, stored as 64-bit prefix ranges.
+  >>> s = IPRangeSet(agg4=2)
+  >>> s.add('192.0.2.1')
+  >>> s.add('192.0.2.2')
+  >>> '192.0.2.1' in s, '192.0.2.5' in s
+  (True, False)
+  >>> s.add('192.0.2.3')
+  >>> '192.0.2.5' in s, '192.0.3.1' in s
+  (True, False)
+  >>> s.add('2001:db8:1:2::5')
+  >>> '2001:db8:1:2:ffff::1' in s, '2001:db8:1:3::5' in s
+  (True, False)
+  >>> s.add('198.51.100.0/23')
+  >>> '198.51.101.7' in s, len(s)
+  (True, 3)
+  """
+  MAGIC = b'BMSIPR1\n'
+  HEADER = struct.Struct('=8sIIII4x')
+  ORDER = 0x01020304    # detect byte order of cache file
+
+  def __init__(self,agg4=128):
+    self.agg4 = agg4
+    # (starts4,ends4,starts6,ends6), replaced as a whole so that milter
+    # threads testing membership never see a table half updated
+    self.table = (array('I'),array('I'),array('Q'),array('Q'))
+    self.mm = None
+    self.sources = {}   # text file name -> bytes already loaded
+
+  def __len__(self):
+    t = self.table
+    return len(t[0]) + len(t[2])
+
+  ## Return (version,first,last) for an IP or CIDR string, or None.
+  @staticmethod
+  def parse(s):
+    s = s.strip()
+    try:        # fast path for the common case of a bare IP4 address
+      ip = int.from_bytes(socket.inet_pton(socket.AF_INET,s),'big')
+      return 4,ip,ip
+    except OSError: pass
+    try:
+      net = ipaddress.ip_network(s,strict=False)
+    except ValueError:
+      return None
+    if net.version == 6:
+      mapped = net.network_address.ipv4_mapped
+      if mapped and net.prefixlen >= 96:
+        net = ipaddress.ip_network('%s/%d'%(mapped,net.prefixlen-96))
+      else:
+        return 6,int(net.network_address)>>64,int(net.broadcast_address)>>64
+    return 4,int(net.network_address),int(net.broadcast_address)
+
+  def __contains__(self,ipaddr):
+    r = self.parse(ipaddr)
+    if not r: return False
+    ver,ip,_ = r
+    starts4,ends4,starts6,ends6 = self.table
+    if ver == 4:
+      starts,ends = starts4,ends4
+    else:
+      starts,ends = starts6,ends6
+    i = bisect_right(starts,ip) - 1
+    return i >= 0 and ip <= ends[i]
+
+  ## Return private copies of the table arrays to modify and swap in.
+  # Mapped ranges are copied out of the cache file, which is then
+  # forgotten by close().
+  def _copy(self):
+    t = []
+    for a in self.table:
+      if isinstance(a,memoryview):
+        b = array(a.format)
+        b.frombytes(a.cast('B'))
+      else:
+        b = a[:]
+      t.append(b)
+    self.close()
+    return t
+
+  ## Forget the cache file, if any.  The mapped ranges are not released,
+  # since other threads may still be reading them: the file is unmapped
+  # when the last reference to them goes away.
+  def close(self):
+    self.mm = None
+
+  ## Ban an IP or CIDR network given as a string.
+  def add(self,s):
+    r = self.parse(s)
+    if not r: raise ValueError('Invalid ip syntax:'+s)
+    t = self._copy()
+    ver,first,last = r
+    if ver == 6:
+      _insert(t[2],t[3],first,last)
+    else:
+      self._add4(t[0],t[1],first,last)
+    self.table = tuple(t)
+
+  def _add4(self,starts,ends,first,last):
+    _insert(starts,ends,first,last)
+    cnet = first & 0xFFFFFF00
+    if last <= cnet + 0xFF \
+        and _coverage(starts,ends,cnet,cnet+0xFF) > self.agg4:
+      _insert(starts,ends,cnet,cnet+0xFF)
+
+  ## Add IPs and networks from an iterable of lines, ignoring garbage.
+  # Sorts once and merges, rather than inserting one by one.
+  def update(self,lines):
+    new4,new6 = [],[]
+    for ln in lines:
+      r = self.parse(ln)
+      if not r: continue
+      if r[0] == 4: new4.append(r[1:])
+      else: new6.append(r[1:])
+    if len(new4) + len(new6) < len(self) // 16:
+      # a few additions to a large set: insert into a copy
+      t = self._copy()
+      for first,last in new6:
+        _insert(t[2],t[3],first,last)
+      for first,last in new4:
+        self._add4(t[0],t[1],first,last)
+      self.table = tuple(t)
+      return
+    starts4,ends4,starts6,ends6 = self.table
+    r4 = sorted(new4 + list(zip(starts4,ends4)))
+    r6 = sorted(new6 + list(zip(starts6,ends6)))
+    starts,ends = _merge(r4,'I')
+    # aggregate class C networks with more than agg4 banned addresses
+    cnets = {}
+    for first,last in zip(starts,ends):
+      cnet = first & 0xFFFFFF00
+      if last <= cnet + 0xFF:
+        cnets[cnet] = cnets.get(cnet,0) + last - first + 1
+    agg = sorted((c,c+0xFF) for c,n in cnets.items() if n > self.agg4)
+    if agg:
+      starts,ends = _merge(sorted(agg + list(zip(starts,ends))),'I')
+    self.close()
+    self.table = (starts,ends) + _merge(r6,'Q')
+
+  ## Write the ranges to a binary cache file that load() can mmap.
+  def save(self,fname):
+    manifest = ''.join('%d\t%s\n'%(n,fn)
+        for fn,n in sorted(self.sources.items())).encode()
+    manifest += b'\0' * (-len(manifest) % 8)
+    tmp = fname + '.tmp'
+    t = self.table
+    with open(tmp,'wb') as fp:
+      fp.write(self.HEADER.pack(self.MAGIC,self.ORDER,
+          len(t[0]),len(t[2]),len(manifest)))
+      fp.write(manifest)
+      for a in t:
+        fp.write(a.tobytes() if isinstance(a,array) else a)
+    os.rename(tmp,fname)
+
+  ## Map a binary cache file written by save().
+  # The ranges are used in place until the first add().
+  def load(self,fname):
+    with open(fname,'rb') as fp:
+      mm = mmap.mmap(fp.fileno(),0,access=mmap.ACCESS_READ)
+    arrays = []
+    try:
+      magic,order,n4,n6,mlen = self.HEADER.unpack_from(mm)
+      if magic != self.MAGIC or order != self.ORDER:
+        raise ValueError('%s: not a banned ips cache'%fname)
+      pos = self.HEADER.size
+      sources = {}
+      for ln in mm[pos:pos+mlen].rstrip(b'\0').decode().splitlines():
+        n,fn = ln.split('\t',1)
+        sources[fn] = int(n)
+      pos += mlen
+      with memoryview(mm) as mv:
+        for n,size,typecode in ((n4,4,'I'),(n4,4,'I'),(n6,8,'Q'),(n6,8,'Q')):
+          if n * size + pos > len(mm):
+            raise ValueError('%s: truncated'%fname)
+          with mv[pos:pos+n*size] as b:
+            arrays.append(b.cast(typecode))
+          pos += n*size
+    except:
+      for a in arrays: a.release()
+      mm.close()
+      raise
+    self.table = tuple(arrays)
+    self.mm = mm
+    self.sources = sources
+
+  ## Load banned IPs from text files, using a binary cache when possible.
+  # The text files are append only logs, so when every file is at least
+  # as long as when the cache was saved, only the new lines are parsed.
+  # Otherwise (e.g. after rotation), all files are parsed and the
+  # cache is rewritten.
+  def load_files(self,files,cache=None):
+    sizes = dict((fn,os.path.getsize(fn)) for fn in files)
+    if cache and os.path.exists(cache):
+      try:
+        self.load(cache)
+        if set(self.sources) != set(sizes) or any(
+            sizes[fn] < n for fn,n in self.sources.items()):
+          self.close()
+          self.__init__(self.agg4)
+      except (ValueError,struct.error):
+        self.__init__(self.agg4)
+    changed = False
+    for fn in files:
+      pos = self.sources.get(fn,0)
+      if sizes[fn] > pos:
+        with open(fn,'rb') as fp:
+          fp.seek(pos)
+          data = fp.read(sizes[fn] - pos)
+        # leave any partial last line for next time
+        data = data[:data.rfind(b'\n')+1]
+        self.update(data.decode('latin1').splitlines())
+        self.sources[fn] = pos + len(data)
+        changed = True
+    if cache and changed:
+      self.save(cache)
+    return self
+
+## Merge sorted (first,last) pairs into starts/ends arrays.
+def _merge(ranges,typecode):
+  starts,ends = array(typecode),array(typecode)
+  for first,last in ranges:
+    if ends and ends[-1] + 1 >= first:
+      if last > ends[-1]: ends[-1] = last
+    else:
+      starts.append(first)
+      ends.append(last)
+  return starts,ends
@@ -82,7 +82,7 @@ mkdir -p $RPM_BUILD_ROOT%{logdir}/save
 mkdir -p $RPM_BUILD_ROOT%{datadir}
 mkdir -p $RPM_BUILD_ROOT%{_libexecdir}/milter
 cp *.txt $RPM_BUILD_ROOT%{datadir}
-cp -p bms.py spfmilter.py dkim-milter.py ban2zone.py $RPM_BUILD_ROOT%{_libexecdir}/milter
+cp -p bms.py ipranges.py spfcache.py dnscache.py accesstable.py addrstore.py addrpat.py greyengine.py wordmatch.py subjectrules.py headerstore.py msgview.py dkimstream.py spfmilter.py dkim-milter.py ban2zone.py $RPM_BUILD_ROOT%{_libexecdir}/milter
 chmod a+x $RPM_BUILD_ROOT%{_libexecdir}/milter/*.py
 cp milter.cfg $RPM_BUILD_ROOT/etc/mail/pymilter.cfg
 cp spfmilter.cfg $RPM_BUILD_ROOT/etc/mail
@@ -223,6 +223,18 @@ fi
 %dir %{datadir}
 %{_libexecdir}/milter/bms.py
 %{_libexecdir}/milter/ban2zone.py
+%{_libexecdir}/milter/ipranges.py
+%{_libexecdir}/milter/spfcache.py
+%{_libexecdir}/milter/dnscache.py
+%{_libexecdir}/milter/accesstable.py
+%{_libexecdir}/milter/addrstore.py
+%{_libexecdir}/milter/addrpat.py
+%{_libexecdir}/milter/greyengine.py
+%{_libexecdir}/milter/wordmatch.py
+%{_libexecdir}/milter/subjectrules.py
+%{_libexecdir}/milter/headerstore.py
+%{_libexecdir}/milter/msgview.py
+%{_libexecdir}/milter/dkimstream.py
 %config(noreplace) %{datadir}/strike3.txt
 %config(noreplace) %{datadir}/softfail.txt
 %config(noreplace) %{datadir}/fail.txt
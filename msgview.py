@@ -0,0 +1,73 @@
+## @package msgview
+# Read only views of a spooled message without copying it.
+#
+# DKIM and dspam each want the message as one string, with headers
+# that are serialized separately from the body in the spool.  Reading
+# the spool and then concatenating headers and body copies a large
+# message several times over.  A MessageView maps the body in place:
+# the buffer of an in memory spool, or an mmap of one that spilled to
+# disk.  The text for a set of headers is then built with a single copy,
+# and kept for the next caller that asks for the same headers.
+#
+# Author: Stuart D. Gathman <stuart@gathman.org>
+# This code is under the GNU General Public License.  See COPYING for details.
+
+import os
+import mmap
+
+## Return a read only view of everything in fp, and the mmap if any.
+# @param fp a BytesIO, a real file, or a SpooledTemporaryFile of either
+def buffer_view(fp):
+  f = getattr(fp,'_file',fp)    # unwrap SpooledTemporaryFile
+  if hasattr(f,'getbuffer'):
+    return f.getbuffer().toreadonly(),None
+  f.flush()
+  if os.fstat(f.fileno()).st_size == 0:
+    return memoryview(b''),None     # can't mmap an empty file
+  m = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+  return memoryview(m),m
+
+class MessageView(object):
+  """Headers plus a view of the message body in a spool.
+
+  >>> from io import BytesIO
+  >>> fp = BytesIO(b'Subject: Hi\\n\\nHello\\n')
+  >>> v = MessageView(fp,13)
+  >>> v.size(b'Subject: Hi\\n'), bytes(v.body)
+  (19, b'Hello\\n')
+  >>> h = b'Subject: Hi\\nX-Note: added\\n'
+  >>> txt = v.text(h); txt
+  b'Subject: Hi\\nX-Note: added\\n\\nHello\\n'
+  >>> v.text(h) is txt
+  True
+  >>> v.release(); fp.close()
+  """
+
+  def __init__(self,fp,offset=0):
+    self.fp = fp
+    self.buf,self.map = buffer_view(fp)
+    self.body = self.buf[offset:]
+    self.headers = None
+    self.txt = None
+
+  ## Length of the text for headers, without building it.
+  def size(self,headers):
+    return len(headers) + 1 + len(self.body)
+
+  ## Return headers, a blank line, and the body as one string.
+  # The last text built is kept, so headers should be the same object
+  # on each call while they are unchanged.
+  def text(self,headers):
+    if headers is not self.headers:
+      self.txt = b''.join((headers,b'\n',self.body))
+      self.headers = headers
+    return self.txt
+
+  ## Release the views so the spool can be written or closed.
+  def release(self):
+    self.body.release()
+    self.buf.release()
+    if self.map:
+      self.map.close()
+      self.map = None
+    self.headers = self.txt = None
@@ -0,0 +1,378 @@
+## @package spfcache
+# Process wide cache of SPF results.
+#
+# Bulk senders open thousands of connections per hour from the same IPs
+# with the same MAIL FROM domain and HELO name, and each one used to pay
+# for a full SPF evaluation.  SPFCache keeps recent verdicts, shared by
+# all milter threads, with LRU eviction and an expiration time.
+#
+# ForwarderIndex compiles the SPF records of trusted forwarders into
+# IP ranges, refreshed periodically, so that checking a connect IP
+# against them is usually a local lookup.  Forwarders with records that
+# cannot be compiled are evaluated concurrently on a shared worker pool.
+#
+# Author: Stuart D. Gathman <stuart@gathman.org>
+# This code is under the GNU General Public License.  See COPYING for details.
+
+import re
+import time
+import threading
+import ipaddress
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError
+from ipranges import NetIndex
+
+try: import spf
+except: spf = None
+
+# query attributes set by check() that are used after the result
+_STATE = ('perm_error','mechanism','mech','prob')
+
+# macros that make the result depend on more than the sender domain
+RE_SENDER_MACRO = re.compile(br'%{[lsLS]',re.IGNORECASE)
+
+# marks a domain whose records use sender macros, so results are
+# cached by full sender instead
+PER_SENDER = object()
+
+class SPFCache(object):
+  """Thread safe LRU cache with expiration.
+  >>> c = SPFCache(maxsize=2,ttl=60)
+  >>> c.put('a',1); c.put('b',2); c.get('a')
+  1
+  >>> c.put('c',3); c.get('b') is None, len(c), c.evictions
+  (True, 2, 1)
+  >>> c.put('d',4,ttl=-1); c.get('d') is None
+  True
+  >>> c.hits,c.misses
+  (1, 2)
+  """
+
+  def __init__(self,maxsize=10000,ttl=600):
+    self.maxsize = maxsize
+    self.ttl = ttl                      # maximum seconds to keep results
+    self.resolver = None                # dnscache.Resolver supplying TTLs
+    self.cache = OrderedDict()
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def __len__(self):
+    return len(self.cache)
+
+  def get(self,key):
+    now = time.time()
+    with self.lock:
+      try:
+        expires,val = self.cache[key]
+      except KeyError:
+        self.misses += 1
+        return None
+      if expires < now:
+        del self.cache[key]
+        self.misses += 1
+        return None
+      self.cache.move_to_end(key)
+      self.hits += 1
+      return val
+
+  def put(self,key,val,ttl=None):
+    if ttl is None: ttl = self.ttl
+    with self.lock:
+      self.cache[key] = (time.time() + ttl,val)
+      self.cache.move_to_end(key)
+      while len(self.cache) > self.maxsize:
+        self.cache.popitem(last=False)
+        self.evictions += 1
+
+  def stats(self):
+    "Return a one line summary for the log."
+    total = self.hits + self.misses
+    return '%d entries, %d hits, %d misses (%.1f%%), %d evicted' % (
+        len(self.cache),self.hits,self.misses,
+        total and 100.0*self.hits/total,self.evictions)
+
+## True if DNS data seen by the query used local-part or sender macros.
+def uses_sender_macros(q):
+  for (name,qtype),vals in q.cache.items():
+    if qtype != 'TXT': continue
+    for v in vals:
+      try:
+        if RE_SENDER_MACRO.search(b''.join(v)): return True
+      except TypeError: pass
+  return False
+
+## Evaluate an SPF query through the cache.
+# On a hit, the query attributes used after check() are restored, so
+# callers can use q as if check() had run.  Temporary errors are never
+# cached.  A default explanation is not cached, but taken from q, since
+# it may be set per sender.
+# @param cache SPFCache, or None to simply run the query
+# @param q spf.query
+# @param guess True to call q.best_guess() instead of q.check()
+# @param record optional SPF record passed to check() or best_guess()
+# @param ttl seconds to keep the result, default is the smallest DNS TTL
+# seen by cache.resolver, but no more than cache.ttl
+# @return (result, mta-status-code, explanation)
+def check(cache,q,guess=False,record=None,ttl=None):
+  def run():
+    if not guess:
+      return q.check(record)
+    if record:
+      return q.best_guess(record)
+    return q.best_guess()
+  if cache is None:
+    return run()
+  key = (guess,q.c,q.o.lower(),q.h and q.h.lower(),record)
+  r = cache.get(key)
+  if r is PER_SENDER:
+    key += (q.l,)
+    r = cache.get(key)
+  if r:
+    (res,code,exp),state = r
+    for k,v in state.items():
+      setattr(q,k,v)
+    if exp is None:
+      exp = q.defexps.get(res)
+    return res,code,exp
+  resolver = cache.resolver
+  if resolver: resolver.mark()
+  rc = run()
+  if rc[0] in ('temperror','error'):
+    return rc
+  if ttl is None and resolver:
+    ttl = resolver.min_ttl()
+    if ttl is not None: ttl = min(ttl,cache.ttl)
+  if uses_sender_macros(q):
+    cache.put(key,PER_SENDER,ttl)
+    key += (q.l,)
+  res,code,exp = rc
+  if exp == q.defexps.get(res):
+    exp = None          # the caller's default may name the sender
+  cache.put(key,((res,code,exp),dict((k,getattr(q,k,None)) for k in _STATE)),
+      ttl)
+  return rc
+
+## Return first SPF pass among forwarder queries, or None.
+# A forwarder without an SPF record gets a best guess of 'v=spf1 a mx'.
+# With an executor, the queries run concurrently, and those not yet
+# started are cancelled once one passes.  Queries still waiting for a
+# worker after timeout seconds are run in the calling thread, so a busy
+# pool doesn't lose a forwarder pass.
+# @param cache SPFCache or None
+# @param queries list of HELO spf.query objects for trusted forwarders
+# @param executor optional concurrent.futures executor
+# @param timeout seconds to wait for concurrent queries to pass
+# @return (q,(result,code,explanation)) for the passing query
+def first_pass(cache,queries,executor=None,timeout=None):
+  def run(q):
+    rc = check(cache,q)
+    if rc[0] == 'none':
+      rc = check(cache,q,True,'v=spf1 a mx')
+    return q,rc
+  if not executor:
+    for q in queries:
+      q,rc = run(q)
+      if rc[0] == 'pass': return q,rc
+    return None
+  futures = [executor.submit(run,q) for q in queries]
+  try:
+    for f in as_completed(futures,timeout):
+      q,rc = f.result()
+      if rc[0] == 'pass': return q,rc
+  except TimeoutError:
+    for q,f in zip(queries,futures):
+      if f.cancel():
+        q,rc = run(q)
+        if rc[0] == 'pass': return q,rc
+  finally:
+    for f in futures: f.cancel()
+  return None
+
+_pool = None
+_speculative_pool = None
+_pool_lock = threading.Lock()
+
+## Return the process wide worker pool for SPF queries.
+def pool(workers=4):
+  global _pool
+  with _pool_lock:
+    if _pool is None:
+      _pool = ThreadPoolExecutor(max_workers=workers)
+    return _pool
+
+## Return the process wide pool for work that may not be needed,
+# such as the speculative HELO query and forwarder refresh.  It is kept
+# apart from pool() so that it never delays a MAIL FROM verdict.
+def speculative_pool(workers=2):
+  global _speculative_pool
+  with _pool_lock:
+    if _speculative_pool is None:
+      _speculative_pool = ThreadPoolExecutor(max_workers=workers)
+    return _speculative_pool
+
+## Wait for the (result,code,explanation) of a concurrent SPF check.
+# A check still waiting for a worker is cancelled and run in the
+# calling thread, so a busy pool costs no more than a serial check.
+# A check still running after timeout seconds is a temperror.
+# @param run function to call for the result if the check hasn't started
+def result(future,timeout=30,run=None):
+  if run and future.cancel():
+    return run()
+  try:
+    return future.result(timeout)
+  except TimeoutError:
+    future.cancel()
+    return 'temperror',451,'SPF check timed out'
+
+## Set the state of q as if check() had passed on mechanism mech.
+# @return (result, mta-status-code, explanation)
+def compiled_pass(q,mech):
+  q.mechanism = mech
+  q.perm_error = None
+  q.mech = []
+  q.prob = None
+  return 'pass',250,'sender SPF authorized'
+
+class ForwarderIndex(object):
+  """Trusted forwarder SPF records compiled to IP ranges.
+
+  Records are compiled when they use only ip4, ip6, a, mx, include and
+  redirect with a pass qualifier, and no macros.  Other forwarders
+  are returned by lookup() for a live query.
+  """
+
+  ## Maximum DNS lookups while compiling a record, as for check().
+  MAX_LOOKUP = 10
+
+  def __init__(self,forwarders,refresh=3600):
+    self.forwarders = list(forwarders)
+    self.refresh = refresh
+    self.lock = threading.Lock()
+    self.index = None             # NetIndex with a tag bit per forwarder
+    self.nets = {}                # tag -> (forwarder,[(network,mech)])
+    self.live = self.forwarders   # forwarders needing a live query
+    self.expires = 0
+    self.updating = False
+
+  ## Compile the SPF record for a forwarder.
+  # A forwarder with no SPF record gets the best guess 'v=spf1 a mx'.
+  # @return list of (network,mechanism), or None if not compilable
+  def compile(self,domain):
+    q = spf.query('127.0.0.1','',domain,strict=False)
+    nets = []
+    record = q.dns_spf(domain) or 'v=spf1 a mx'
+    if self._compile(q,domain,record,nets,[0]):
+      return nets
+    return None
+
+  def _compile(self,q,domain,record,nets,lookups):
+    if record is None: return False     # include with no record
+    redirect = None
+    for term in record.split()[1:]:
+      if '%' in term: return False
+      name,sep,val = term.partition('=')
+      if sep and ':' not in name and '/' not in name:
+        if name.lower() == 'redirect': redirect = val
+        continue
+      qual = '+'
+      if term[0] in '+-~?':
+        qual,term = term[0],term[1:]
+      m,arg,cidr,cidr6 = spf.parse_mechanism(term,domain)
+      if m == 'all':
+        if qual == '+': return False
+        redirect = None
+        break
+      if qual != '+': return False
+      if m in ('ip4','ip6'):
+        nets.append((ipaddress.ip_network(
+          arg if cidr is None else '%s/%d'%(arg,cidr),strict=False),term))
+        continue
+      lookups[0] += 1
+      if lookups[0] > self.MAX_LOOKUP: return False
+      # both address families are looked up here, but only one is for
+      # a live query, so don't let the other count as void lookups
+      q.void_lookups = 0
+      if m == 'include':
+        if not self._compile(q,arg,q.dns_spf(arg),nets,lookups):
+          return False
+      elif m in ('a','mx'):
+        if m == 'a':
+          hosts = [arg]
+        else:
+          hosts = [mx for pri,mx in sorted(q.dns(arg,'MX'))[:spf.MAX_MX]]
+        for host in hosts:
+          for a,n in (('A',cidr or 32),('AAAA',cidr6 or 128)):
+            for ip in q.dns_a(host,a):
+              ip = ipaddress.ip_address(ip)
+              nets.append((ipaddress.ip_network(
+                '%s/%d'%(ip,min(n,ip.max_prefixlen)),strict=False),term))
+      else:
+        return False
+    if redirect:
+      lookups[0] += 1
+      if lookups[0] > self.MAX_LOOKUP: return False
+      return self._compile(q,redirect,q.dns_spf(redirect),nets,lookups)
+    return True
+
+  ## Recompile all forwarder records.
+  def update(self):
+    index = NetIndex()
+    nets = {}
+    live = []
+    for i,tf in enumerate(self.forwarders):
+      try:
+        r = self.compile(tf)
+      except (spf.TempError,spf.PermError,ValueError):
+        r = None
+      if r is None:
+        live.append(tf)
+        continue
+      tag = 1<<i
+      index.add(tag,[str(n) for n,mech in r])
+      nets[tag] = (tf,r)
+    index.build()
+    with self.lock:
+      self.index,self.nets,self.live = index,nets,live
+      self.expires = time.time() + self.refresh
+      self.updating = False
+
+  ## Check an IP against the compiled forwarders.
+  # Records are compiled on first use, and recompiled in the background
+  # with executor after refresh seconds.
+  # @return ((forwarder,mechanism) or None, forwarders needing live query)
+  def lookup(self,ipaddr,executor=None):
+    """
+    >>> fi = ForwarderIndex(['fwd.example.com'])
+    >>> fi.index = NetIndex(); fi.index.add(1,['192.0.2.0/24'])
+    >>> fi.nets = { 1: ('fwd.example.com',
+    ...     [(ipaddress.ip_network('192.0.2.0/24'),'ip4:192.0.2.0/24')]) }
+    >>> fi.live = []; fi.expires = time.time() + 60
+    >>> fi.lookup('192.0.2.7')
+    (('fwd.example.com', 'ip4:192.0.2.0/24'), [])
+    >>> fi.lookup('::ffff:192.0.2.7')[0]
+    ('fwd.example.com', 'ip4:192.0.2.0/24')
+    >>> fi.lookup('198.51.100.1')
+    (None, [])
+    """
+    if self.index is None:
+      self.update()
+    elif self.expires < time.time():
+      with self.lock:
+        start = not self.updating
+        self.updating = True
+      if start:
+        if executor: executor.submit(self.update)
+        else: self.update()
+    with self.lock:
+      index,nets,live = self.index,self.nets,self.live
+    ip = ipaddress.ip_address(ipaddr)
+    if ip.version == 6 and ip.ipv4_mapped:
+      ip = ip.ipv4_mapped
+    mask = index.lookup(str(ip))
+    if mask:
+      tf,r = nets[mask & -mask]
+      for n,mech in r:
+        if ip in n: return (tf,mech),live
+    return None,live
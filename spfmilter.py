@@ -14,6 +14,7 @@ import os
 import Milter
 import spf
 import syslog
+import dnscache
 from Milter.config import MilterConfigParser
 from Milter.policy import MTAPolicy
 from Milter.utils import iniplist,parse_addr,ip4re
@@ -29,6 +30,7 @@ class Config(object):
     self.access_file = None
     self.access_file_nulls = False
     self.access_file_colon = True
+    self.dns_cache = None
     #os.umask(config.savumask)
 
 config = None
@@ -57,6 +59,12 @@ def read_config(cfglist):
   conf.access_file = cp.getdefault('spf','access_file',None)
   conf.access_file_nulls = cp.getboolean('spf','access_file_nulls')
   conf.access_file_colon = cp.getboolean('spf','access_file_colon')
+  # DNS cache
+  cache_size = cp.getintdefault('dns','cache_size',50000)
+  if cache_size > 0:
+    conf.dns_cache = dnscache.Resolver(dnscache.default_backend(),cache_size,
+        negative_ttl=cp.getintdefault('dns','negative_ttl',300),
+        max_ttl=cp.getintdefault('dns','max_ttl',86400))
   return conf
 
 class spfMilter(Milter.Base):
@@ -302,5 +310,10 @@ See the sendmail README for libmilter.
 spfmilter startup""" % (miltername,miltername,socketname))
   sys.stdout.flush()
   config.savumask = os.umask(config.umask)
+  if config.dns_cache:
+    dnscache.install_spf(config.dns_cache)
   Milter.runmilter(miltername,socketname,240)
+  if config.dns_cache:
+    for line in config.dns_cache.report():
+      syslog.syslog('dns_cache: %s' % line)
   print("spfmilter shutdown")
@@ -0,0 +1,114 @@
+## @package subjectrules
+# Ordered Subject header rules evaluated in one pass.
+#
+# Each rule is a compiled test of the Subject, and optionally a condition
+# on the milter, with the reply to send when it matches.  The Subject is
+# lowercased and stripped once for all rules.  Besides the built in
+# rules, sites can add rules in the [subject] section of the config:
+#
+#   casino = icontains: casino, jackpot
+#   casino_reply = 550 5.7.1 No gambling
+#
+# Kinds are contains (case sensitive), icontains, prefix, suffix and
+# regex (not case sensitive).
+#
+# Author: Stuart D. Gathman <stuart@gathman.org>
+# This code is under the GNU General Public License.  See COPYING for details.
+
+import re
+from wordmatch import WordMatcher
+
+DEFAULT_REPLY = ('550','5.7.1','That subject is not allowed')
+
+## Return a test(val,lval) for patterns of the given kind.
+# A blank pattern would match every Subject, so it is an error.
+def compile_test(kind,patterns):
+  if not patterns or not all(p.strip() for p in patterns):
+    raise ValueError('Blank pattern in subject rule: %s %r'%(kind,patterns))
+  if kind == 'contains':
+    m = WordMatcher(patterns)
+    return lambda val,lval: m.search(val)
+  patterns = [p.lower() for p in patterns]
+  if kind == 'icontains':
+    m = WordMatcher(patterns)
+    return lambda val,lval: m.search(lval)
+  if kind == 'prefix':
+    t = tuple(patterns)
+    return lambda val,lval: lval.startswith(t)
+  if kind == 'suffix':
+    t = tuple(patterns)
+    return lambda val,lval: lval.endswith(t)
+  if kind == 'regex':
+    r = re.compile('|'.join(patterns),re.IGNORECASE)
+    return lambda val,lval: r.search(lval)
+  raise ValueError('Unknown subject rule kind: ' + kind)
+
+class Rule(object):
+  "A named Subject test with its reply, or None for no reply."
+
+  def __init__(self,name,test,reply=DEFAULT_REPLY,when=None):
+    self.name = name
+    self.test = test            # test(val,lval) is true for a match
+    self.reply = reply          # (code,xcode,msg...)
+    self.when = when            # when(milter) must be true if given
+
+  def __repr__(self):
+    return 'Rule(%s)' % self.name
+
+class SubjectRules(object):
+  """Subject rules tried in order.
+
+  >>> rules = SubjectRules()
+  >>> rules.add('adv',compile_test('prefix',['adv:','[spam]']),
+  ...     ('550','5.7.1','No soliciting allowed'))
+  >>> rules.add('fwd',compile_test('prefix',['fwd:']),
+  ...     when=lambda m: not m.forward)
+  >>> rules.add_config('casino','icontains: Casino, jackpot','550 5.7.1 No gambling')
+  >>> class M: forward = True
+  >>> rules.match('  ADV: buy now',M)
+  Rule(adv)
+  >>> r = rules.match('Online CASINO',M); r.name, r.reply
+  ('casino', ('550', '5.7.1', 'No gambling'))
+  >>> rules.match('Fwd: joke',M), rules.match('Lunch?',M)
+  (None, None)
+  >>> rules.add_config('everything','regex: ')
+  Traceback (most recent call last):
+  ...
+  ValueError: Blank pattern in subject rule: regex ['']
+  """
+
+  def __init__(self):
+    self.rules = []
+
+  def __len__(self):
+    return len(self.rules)
+
+  def add(self,name,test,reply=DEFAULT_REPLY,when=None):
+    self.rules.append(Rule(name,test,reply,when))
+
+  ## Add a rule from the config file.
+  # @param spec kind: pattern, pattern...
+  # @param reply code xcode message, or None for the default
+  def add_config(self,name,spec,reply=None):
+    kind,sep,pats = spec.partition(':')
+    kind = kind.strip().lower()
+    if kind == 'regex':
+      patterns = [pats.strip()]
+    else:
+      patterns = [p.strip() for p in pats.split(',')]
+    if reply:
+      code,xcode,msg = reply.split(None,2)
+      reply = (code,xcode,msg)
+    else:
+      reply = DEFAULT_REPLY
+    self.add(name,compile_test(kind,patterns),reply)
+
+  ## Return the first Rule matching a Subject, or None.
+  # @param milter passed to rule conditions
+  def match(self,val,milter=None):
+    lval = val.lower().strip()
+    for rule in self.rules:
+      if rule.when and not rule.when(milter): continue
+      if rule.test(val,lval):
+        return rule
+    return None
@@ -0,0 +1,52 @@
+#!/usr/bin/python3
+# Microbenchmark of header decoding in bmsMilter.header() on the test/ corpus.
+# Run from the top directory: python3 tests/benchheader.py [repeat]
+import os
+import sys
+import time
+import email
+from email import policy
+from Milter.utils import parse_header
+from bms import decode_header
+
+## Return the header values of each message in the corpus, as the MTA
+# would pass them to header().
+def corpus(dir='test'):
+  for fn in sorted(os.listdir(dir)):
+    path = os.path.join(dir,fn)
+    if not os.path.isfile(path): continue
+    with open(path,'rb') as fp:
+      try:
+        msg = email.message_from_binary_file(fp,policy=policy.compat32)
+      except Exception: continue
+    hdrs = [v for k,v in msg._headers if isinstance(v,str)]
+    if hdrs: yield hdrs
+
+def bench(label,decode,msgs,repeat):
+  n = sum(len(h) for h in msgs) * repeat
+  t = time.perf_counter()
+  for i in range(repeat):
+    for hdrs in msgs:
+      decode(hdrs)
+  t = time.perf_counter() - t
+  print('%-10s %6d headers %8.2f us/header' % (label,n,t*1e6/n))
+  return t
+
+def old(hdrs):
+  for hval in hdrs:
+    parse_header(hval)
+
+def new(hdrs):
+  cache = {}
+  for hval in hdrs:
+    decode_header(hval,cache)
+
+if __name__ == '__main__':
+  repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+  msgs = list(corpus())
+  for hdrs in msgs:
+    for hval in hdrs:
+      assert decode_header(hval,{}) == parse_header(hval)
+  t0 = bench('before',old,msgs,repeat)
+  t1 = bench('after',new,msgs,repeat)
+  print('speedup %.1fx' % (t0/t1))
@@ -1,12 +1,14 @@
 import unittest
 import testbms
 import testspf
+import testdns
 import os
 
 def suite(): 
   s = unittest.TestSuite()
   s.addTest(testspf.suite())
   s.addTest(testbms.suite())
+  s.addTest(testdns.suite())
   return s
 
 if __name__ == '__main__':
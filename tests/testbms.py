@@ -2,6 +2,17 @@ import unittest
 import doctest
 import Milter
 import bms
+import ipranges
+import spfcache
+import accesstable
+import addrstore
+import addrpat
+import greyengine
+import wordmatch
+import subjectrules
+import headerstore
+import msgview
+import dkimstream
 from Milter.test import TestBase
 import mime
 try:
@@ -10,6 +21,9 @@ except:
   from StringIO import BytesIO
 import email
 import sys
+import os
+import shutil
+import tempfile
 import zipfile
 #import pdb
 
@@ -107,6 +121,33 @@ class BMSMilterTestCase(unittest.TestCase):
     milter.log(str)
     milter.close()
 
+  def testSaveName(self):
+    # only a defanged message creates a copy in tempdir
+    d = tempfile.mkdtemp()
+    made = []
+    mkstemp = tempfile.mkstemp
+    def record(*args,**kw):
+      fd,name = mkstemp(*args,**kw)
+      made.append(name)
+      return fd,name
+    save = tempfile.tempdir
+    tempfile.tempdir = d
+    tempfile.mkstemp = record
+    try:
+      milter = TestMilter(self.zf)
+      milter.connect('testSaveName')
+      self.assertEqual(milter.feedMsg('spam7'),Milter.ACCEPT)
+      self.assertEqual(made,[])
+      milter.connect('testSaveName')
+      self.assertEqual(milter.feedMsg('virus1'),Milter.ACCEPT)
+      self.assertTrue(milter._bodyreplaced)
+      self.assertEqual(len(made),1)
+      self.assertEqual(os.listdir(d),[os.path.basename(made[0])])
+    finally:
+      tempfile.mkstemp = mkstemp
+      tempfile.tempdir = save
+      shutil.rmtree(d)
+
   # test some spams that crashed our parser
   def testParse(self,fname='spam7'):
     milter = TestMilter(self.zf)
@@ -254,6 +295,43 @@ From: postmaster@mail.example.com
     ))
     self.assertEqual(sndr,'foo@bar.com')
 
+  def testClassify(self):
+    conf = bms.Config()
+    conf.internal_connect = ['192.168.0.0/16','10.*']
+    conf.trusted_relay = ['192.168.1.5','2001:db8::/32']
+    self.assertEqual(conf.classify('192.168.1.5'),
+        bms.NET_INTERNAL|bms.NET_TRUSTED)
+    self.assertEqual(conf.classify('10.2.3.4'),bms.NET_INTERNAL)
+    self.assertEqual(conf.classify('2001:db8::25'),bms.NET_TRUSTED)
+    self.assertEqual(conf.classify('::1'),bms.NET_LOCALHOST)
+    self.assertEqual(conf.classify('127.0.0.2'),bms.NET_LOCALHOST)
+    self.assertEqual(conf.classify('1.2.3.4'),0)
+
+  def testBannedIPs(self):
+    d = tempfile.mkdtemp()
+    try:
+      fn = os.path.join(d,'banned_ips')
+      cache = os.path.join(d,'banned_ips.bin')
+      with open(fn,'w') as fp:
+        fp.write('192.0.2.1\n192.0.2.7\n2001:db8:5::9\n198.51.100.0/24\n')
+      s = ipranges.IPRangeSet().load_files([fn],cache)
+      self.assertTrue('192.0.2.7' in s)
+      self.assertFalse('192.0.2.8' in s)
+      self.assertTrue('2001:db8:5::1' in s)
+      # second load maps the cache, and picks up appended lines
+      with open(fn,'a') as fp:
+        fp.write('203.0.113.5\n')
+      s = ipranges.IPRangeSet().load_files([fn],cache)
+      self.assertTrue('198.51.100.99' in s)
+      self.assertTrue('203.0.113.5' in s)
+      s = ipranges.IPRangeSet().load_files([fn],cache)
+      self.assertTrue(s.mm)
+      s.add('203.0.113.6')
+      self.assertTrue('203.0.113.6' in s)
+      self.assertTrue('192.0.2.1' in s)
+    finally:
+      shutil.rmtree(d)
+
   def testBanned(self):
     bd = set(('*.foo.bar','*.info','baz.bar'))
     self.assertTrue(bms.isbanned('bif.foo.bar',bd))
@@ -262,6 +340,230 @@ From: postmaster@mail.example.com
     self.assertFalse(bms.isbanned('foo.baz.bar',bd))
     self.assertTrue(bms.isbanned('baz.bar',bd))
 
+  def testDeferSPF(self):
+    if not spf: return
+    milter = TestMilter(self.zf)
+    calls = []
+    def lookup(name,qtype,strict=True,timeout=None):
+      calls.append((name,qtype))
+      return []
+    spf.DNSLookup = lookup
+    save = bms.check_user
+    bms.check_user = { 'example.com': ('good',) }
+    bms.config.defer_spf = True
+    try:
+      rc = milter.connect('testDefer',helo='mail.adv.com',ip='192.0.2.1')
+      self.assertEqual(rc,Milter.CONTINUE)
+      # no DNS queries for a sender with only bad recipients
+      rc = milter.feedMsg('test1','spam@adv.com','bad@example.com')
+      self.assertEqual(rc,Milter.REJECT)
+      self.assertEqual(calls,[])
+      self.assertEqual(milter.envfrom('<spam@adv.com>'),Milter.CONTINUE)
+      milter.envrcpt('<good@example.com>')
+      self.assertTrue(calls)
+      milter.close()
+    finally:
+      bms.check_user = save
+      bms.config.defer_spf = False
+      spf.DNSLookup = DNSLookup
+
+  def testAccessTable(self):
+    nulls = bms.config.access_file_nulls
+    bms.config.access_file_nulls = True     # test/access.db has nulls
+    bms.config.access_file_memory = True
+    try:
+      self.testPolicy()
+    finally:
+      bms.config.access_file_nulls = nulls
+      bms.config.access_file_memory = False
+
+  def testAccessTableAgrees(self):
+    # every key in test/access gives the same answer from memory and disk
+    tags,senders = set(bms.POLICY_TAGS),set(['any@random.com'])
+    with open('test/access') as fp:
+      for ln in fp:
+        key = ln.split(None,1)[0].lower()
+        tag,sep,name = key.replace(':','!',1).partition('!')
+        tags.add(tag)
+        name = name.lstrip('.')
+        if name:
+          senders.add(name if '@' in name else 'user@' + name)
+          senders.add('user@sub.' + name.split('@')[-1])
+    nulls = bms.config.access_file_nulls
+    bms.config.access_file_nulls = True     # test/access.db has nulls
+    try:
+      for sender in sorted(senders):
+        for tag in sorted(tags):
+          pol = []
+          for mem in (False,True):
+            bms.config.access_file_memory = mem
+            with bms.SPFPolicy(sender,conf=bms.config,
+                access_file='test/access.db') as p:
+              pol.append(p.getPolicy(tag))
+          self.assertEqual(pol[0],pol[1],(sender,tag))
+    finally:
+      bms.config.access_file_nulls = nulls
+      bms.config.access_file_memory = False
+
+  def testPolicies(self):
+    try:
+      for memory in (False,True):
+        bms.config.access_file_memory = memory
+        policies = {}
+        with bms.SPFPolicy('foo@bad.example.com',conf=bms.config,
+            access_file='test/access.db',policies=policies) as p:
+          pol = p.getPolicies()
+        self.assertEqual(pol['spf-permerror'],'OK')
+        self.assertEqual(pol.get('spf-pass'),None)
+        # later lookups for the transaction use the saved policies
+        with bms.SPFPolicy('foo@bad.example.com',conf=bms.config,
+            access_file='test/access.db',policies=policies) as p:
+          self.assertEqual(p.acf,None)
+          self.assertEqual(p.getPermErrorPolicy(),'OK')
+    finally:
+      bms.config.access_file_memory = False
+
+  def testAccessPool(self):
+    tmpdir = tempfile.mkdtemp()
+    try:
+      fname = os.path.join(tmpdir,'access.db')
+      shutil.copy('test/access.db',fname)
+      pool = bms.AccessPool(interval=0)
+      acf = pool.get(fname)
+      self.assertTrue(pool.get(fname) is acf)
+      st = os.stat(fname)
+      os.utime(fname,(st.st_atime,st.st_mtime + 10))
+      self.assertTrue(pool.get(fname) is not acf)
+    finally:
+      shutil.rmtree(tmpdir)
+
+  def testSubjectRules(self):
+    config = bms.Config()
+    config.spam_words = wordmatch.WordMatcher(['$$$'])
+    config.porn_words = wordmatch.WordMatcher(['viag'])
+    config.subject_config = [('casino','icontains: Casino',None)]
+    rules = config.getSubjectRules()
+    class M: forward = False; postmaster_reply = False
+    for subj,name in (('Win $$$','spam_words'),('ADV: cheap','adv'),
+        ('Cheap VIAGRA','porn_words'),('Fwd: joke','forward'),
+        ('Online casino','casino'),('Lunch?',None)):
+      rule = rules.match(subj,M)
+      self.assertEqual(rule and rule.name,name)
+
+  def testAddrStore(self):
+    tmpdir = tempfile.mkdtemp()
+    try:
+      log = os.path.join(tmpdir,'blacklist.log')
+      with open(log,'w') as fp:
+        fp.write('spammer@example.com\n')
+      c = addrstore.AddrStore(renew=30)
+      c.load(log)
+      self.assertTrue(os.path.exists(os.path.join(tmpdir,'blacklist.sqlite')))
+      self.assertTrue('spammer@example.com' in c)
+      c['bad@example.net'] = None
+      c.close()
+      # only lines appended since the last load are imported
+      with open(log,'a') as fp:
+        fp.write('example.org\n')
+      c = addrstore.AddrStore(renew=30)
+      c.load(log)
+      self.assertTrue('anyone@example.org' in c)
+      self.assertTrue('bad@example.net' in c)
+      c.close()
+      # removing a manual entry from a rewritten log removes it from the db
+      os.unlink(log)
+      with open(log,'w') as fp:
+        fp.write('example.org\n')
+      c = addrstore.AddrStore(renew=30)
+      c.load(log)
+      self.assertFalse('spammer@example.com' in c)
+      self.assertTrue('bad@example.net' in c)
+      c.close()
+    finally:
+      shutil.rmtree(tmpdir)
+
+  def testDKIMStream(self):
+    if not dkimstream.dkim: return
+    from dkim.canonicalization import CanonicalizationPolicy
+    for fname in ('samp1','spam7','test8','bounce','amazon'):
+      with open(os.path.join('test',fname),'rb') as fp:
+        txt = fp.read()
+      headers,body = dkimstream.dkim.rfc822_parse(txt)
+      bh = dkimstream.BodyHashes()
+      for canon in (b'simple',b'relaxed'):
+        bh.add(canon)
+      # feed the body as the MTA would, in odd sized chunks
+      start = txt.index(b'\n\n') + 2
+      for i in range(start,len(txt),1000):
+        bh.update(txt[i:i+1000])
+      for canon in (b'simple',b'relaxed'):
+        cb = CanonicalizationPolicy.from_c_value(b'simple/'+canon) \
+                .canonicalize_body(body)
+        self.assertEqual(bh.get(canon,b'rsa-sha256').digest(),
+                dkimstream.hashlib.sha256(cb).digest(),fname)
+
+  def testSPFCache(self):
+    if not spf: return
+    calls = []
+    def lookup(name,qtype,strict=True,timeout=None):
+      calls.append(name)
+      if name == 'example.com' and qtype == 'TXT':
+        return [((name,qtype),(b'v=spf1 ip4:192.0.2.1 -all',))]
+      return []
+    save = spf.DNSLookup
+    spf.DNSLookup = lookup
+    try:
+      cache = spfcache.SPFCache()
+      for sender in ('a@example.com','b@example.com'):
+        q = spf.query('192.0.2.2',sender,'mail.example.com')
+        q.set_default_explanation('SPF fail: sender=%s' % q.s)
+        res,code,txt = spfcache.check(cache,q)
+        self.assertEqual(res,'fail')
+        self.assertEqual(txt,'SPF fail: sender=%s' % sender)
+        self.assertEqual(q.mechanism,'-all')
+      self.assertEqual(len(calls),1)
+      self.assertEqual(cache.hits,1)
+    finally:
+      spf.DNSLookup = save
+
+  def testForwarders(self):
+    if not spf: return
+    zone = {
+      ('fwd.example.com','TXT'): [(b'v=spf1 ip4:192.0.2.0/24 mx -all',)],
+      ('fwd.example.com','MX'): [(10,'mx.fwd.example.com')],
+      ('mx.fwd.example.com','A'): ['198.51.100.5'],
+      ('macro.example.com','TXT'): [(b'v=spf1 exists:%{i}.bl.example.com',)]
+    }
+    def lookup(name,qtype,strict=True,timeout=None):
+      return [((name,qtype),v) for v in zone.get((name,qtype),[])]
+    save = spf.DNSLookup
+    spf.DNSLookup = lookup
+    try:
+      fi = spfcache.ForwarderIndex(['macro.example.com','fwd.example.com'])
+      self.assertEqual(fi.lookup('198.51.100.5'),
+          (('fwd.example.com','mx'),['macro.example.com']))
+      self.assertEqual(fi.lookup('192.0.2.9')[0][1],'ip4:192.0.2.0/24')
+      self.assertEqual(fi.lookup('203.0.113.1')[0],None)
+      qs = [spf.query('192.0.2.9','',tf,strict=False)
+        for tf in ('macro.example.com','fwd.example.com')]
+      q,rc = spfcache.first_pass(None,qs,spfcache.pool())
+      self.assertEqual((q.h,rc[0]),('fwd.example.com','pass'))
+    finally:
+      spf.DNSLookup = save
+
+  def testSPFQueued(self):
+    # a check still waiting for a busy worker runs in the caller
+    from concurrent.futures import ThreadPoolExecutor
+    import threading
+    busy = threading.Event()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+      executor.submit(busy.wait,10)
+      f = executor.submit(lambda: ('neutral',250,'worker'))
+      rc = spfcache.result(f,1,lambda: ('pass',250,'inline'))
+      busy.set()
+    self.assertEqual(rc,('pass',250,'inline'))
+    self.assertTrue(f.cancelled())
+
 #  def testReject(self):
 #    "Test content based spam rejection."
 #    milter = TestMilter(self.zf)
@@ -273,6 +575,17 @@ From: postmaster@mail.example.com
 def suite(): 
   s = unittest.makeSuite(BMSMilterTestCase,'test')
   s.addTest(doctest.DocTestSuite(bms))
+  s.addTest(doctest.DocTestSuite(ipranges))
+  s.addTest(doctest.DocTestSuite(spfcache))
+  s.addTest(doctest.DocTestSuite(accesstable))
+  s.addTest(doctest.DocTestSuite(addrstore))
+  s.addTest(doctest.DocTestSuite(addrpat))
+  s.addTest(doctest.DocTestSuite(greyengine))
+  s.addTest(doctest.DocTestSuite(wordmatch))
+  s.addTest(doctest.DocTestSuite(subjectrules))
+  s.addTest(doctest.DocTestSuite(headerstore))
+  s.addTest(doctest.DocTestSuite(msgview))
+  s.addTest(doctest.DocTestSuite(dkimstream))
   return s
 
 if __name__ == '__main__':
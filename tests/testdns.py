@@ -0,0 +1,131 @@
+import unittest
+import doctest
+import threading
+import time
+import dnscache
+import spfcache
+import spf
+
+class FakeBackend(object):
+  "Answers from a zone dict, counting queries."
+
+  def __init__(self,zone):
+    self.zone = zone
+    self.calls = []
+    self.delay = 0
+
+  def __call__(self,name,qtype,timeout):
+    self.calls.append((name,qtype))
+    if self.delay: time.sleep(self.delay)
+    r = self.zone.get((name.lower(),qtype))
+    if r == 'TIMEOUT':
+      raise dnscache.DNSError('DNS timeout')
+    if r is None:
+      return [],None
+    return r
+
+zone = {
+  ('example.com','TXT'): ([(b'v=spf1 ip4:192.0.2.0/24 a -all',)],60),
+  ('example.com','A'): (['198.51.100.1'],30),
+  ('short.example.com','A'): (['198.51.100.2'],0),
+  ('error.example.com','TXT'): 'TIMEOUT'
+}
+
+class DNSCacheTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.backend = FakeBackend(dict(zone))
+    self.resolver = dnscache.Resolver(self.backend)
+
+  def testTTL(self):
+    r = self.resolver
+    r.mark()
+    self.assertEqual(r.lookup('example.com','A'),
+        [(('example.com','A'),'198.51.100.1')])
+    r.lookup('example.com','A')
+    self.assertEqual(len(self.backend.calls),1)
+    self.assertTrue(29 <= r.min_ttl() <= 30)
+    # a zero TTL is never cached
+    r.lookup('short.example.com','A')
+    r.lookup('short.example.com','A')
+    self.assertEqual(len(self.backend.calls),3)
+    self.assertEqual(r.min_ttl(),0)
+    # expired entries are queried again
+    r.cache[('example.com','A')] = (time.time() - 1,['198.51.100.1'])
+    r.lookup('example.com','A')
+    self.assertEqual(len(self.backend.calls),4)
+
+  def testNegative(self):
+    r = self.resolver
+    self.assertEqual(r.lookup('nx.example.com','A'),[])
+    self.assertEqual(r.lookup('NX.example.com.','A'),[])
+    self.assertEqual(len(self.backend.calls),1)
+    self.assertEqual(r.stats['A'].negative,1)
+    # errors are not cached
+    self.assertRaises(dnscache.DNSError,r.lookup,'error.example.com','TXT')
+    self.assertRaises(dnscache.DNSError,r.lookup,'error.example.com','TXT')
+    self.assertEqual(r.stats['TXT'].errors,2)
+
+  def testSingleFlight(self):
+    r = self.resolver
+    self.backend.delay = 0.2
+    results = []
+    def run():
+      results.append(r.lookup('example.com','TXT'))
+    threads = [threading.Thread(target=run) for i in range(5)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    self.assertEqual(len(self.backend.calls),1)
+    self.assertEqual(len(results),5)
+    self.assertEqual(r.stats['TXT'].shared,4)
+
+  def testPrefetch(self):
+    r = self.resolver
+    r.lookup('example.com','TXT')
+    executor = dnscache.prefetch_pool()
+    r.prefetch(executor,[('example.com','TXT'),('example.com','A')])
+    executor.submit(time.sleep,0).result()
+    for i in range(50):
+      if ('example.com','A') in r.cache: break
+      time.sleep(0.01)
+    self.assertEqual(len(self.backend.calls),2)
+    r.lookup('example.com','A')
+    self.assertEqual(r.stats['A'].hits,1)
+    # prefetches beyond max_pending are dropped
+    r.prefetching = 1
+    r.prefetch(executor,[('example.org','TXT')],max_pending=1)
+    self.assertEqual(r.dropped,1)
+    r.prefetching = 0
+
+  def testLRU(self):
+    r = dnscache.Resolver(self.backend,maxsize=2)
+    for name in ('a.example.com','b.example.com','c.example.com'):
+      r.lookup(name,'A')
+    self.assertEqual(len(r.cache),2)
+    self.assertTrue(('a.example.com','A') not in r.cache)
+
+  def testSPF(self):
+    save = spf.DNSLookup
+    try:
+      dnscache.install_spf(self.resolver)
+      cache = spfcache.SPFCache(ttl=600)
+      cache.resolver = self.resolver
+      for sender in ('a@example.com','b@example.com'):
+        q = spf.query('198.51.100.1',sender,'mail.example.com')
+        self.assertEqual(spfcache.check(cache,q)[0],'pass')
+      self.assertEqual(cache.hits,1)
+      # SPF result expires with the smallest TTL used
+      expires,val = list(cache.cache.values())[0]
+      self.assertTrue(expires - time.time() <= 30)
+      q = spf.query('198.51.100.1','a@error.example.com','mail.example.com')
+      self.assertEqual(q.check()[0],'temperror')
+    finally:
+      spf.DNSLookup = save
+
+def suite():
+  s = unittest.makeSuite(DNSCacheTestCase,'test')
+  s.addTest(doctest.DocTestSuite(dnscache))
+  return s
+
+if __name__ == '__main__':
+  unittest.TextTestRunner().run(suite())
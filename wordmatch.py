@@ -0,0 +1,92 @@
+## @package wordmatch
+# Find any of a list of words in a string in a single pass.
+#
+# Header checks look for every word in a list with str.find(), so the
+# cost grows with the length of the list times the length of the header.
+# WordMatcher compiles the list into an Aho-Corasick automaton once,
+# and then scans each header one character at a time whatever the
+# number of words.  For short lists, a loop over str.find() in C is
+# still quicker, so those are kept as a list.
+#
+# Author: Stuart D. Gathman <stuart@gathman.org>
+# This code is under the GNU General Public License.  See COPYING for details.
+
+from collections import deque
+
+## Lists with more words than this are compiled into an automaton.
+MAX_FIND = 16
+
+class WordMatcher(object):
+  """Match any of a list of words, like a loop over str.find().
+
+  >>> m = WordMatcher(['he','she','his','hers'],max_find=0)
+  >>> m.search('ushers'), m.search('this'), m.search('hi there')
+  ('she', 'his', 'he')
+  >>> m.search('nothing'), len(m), 'hers' in m.words
+  (None, 4, True)
+  >>> WordMatcher(['$$$','XXX']).search('Win $$$ now')
+  '$$$'
+  >>> bool(WordMatcher([]))
+  False
+  """
+
+  def __init__(self,words=(),max_find=MAX_FIND):
+    self.words = list(words)
+    self.goto = None
+    if len(self.words) > max_find:
+      self._compile()
+
+  def __len__(self):
+    return len(self.words)
+
+  def __iter__(self):
+    return iter(self.words)
+
+  def _compile(self):
+    goto = [{}]                 # state -> {char: state}
+    out = [None]                # state -> word ending here, if any
+    for w in self.words:
+      if not w: continue
+      s = 0
+      for c in w:
+        t = goto[s].get(c)
+        if t is None:
+          t = len(goto)
+          goto[s][c] = t
+          goto.append({})
+          out.append(None)
+        s = t
+      if out[s] is None: out[s] = w
+    # breadth first, so the fail state of every parent is done first
+    fail = [0]*len(goto)
+    queue = deque(goto[0].values())
+    while queue:
+      s = queue.popleft()
+      for c,t in goto[s].items():
+        queue.append(t)
+        f = fail[s]
+        while f and c not in goto[f]:
+          f = fail[f]
+        f = goto[f].get(c,0)
+        fail[t] = f
+        if out[t] is None: out[t] = out[f]
+    self.goto,self.fail,self.out = goto,fail,out
+
+  ## Return a word found in s, or None.
+  def search(self,s):
+    goto = self.goto
+    if goto is None:
+      for w in self.words:
+        if s.find(w) >= 0: return w
+      return None
+    fail,out = self.fail,self.out
+    state = 0
+    for c in s:
+      t = goto[state].get(c)
+      while t is None and state:
+        state = fail[state]
+        t = goto[state].get(c)
+      state = t or 0
+      if out[state] is not None:
+        return out[state]
+    return None